@@ -25,19 +25,33 @@ import hashlib
 import re
 import getopt
 import subprocess
+import threading
+import time
+import ssl
 from subprocess import PIPE
-from os import (environ, mkdir, chdir, makedirs, unlink)
-from os.path import (dirname, basename)
+from os import (mkdir, chdir, makedirs, unlink)
+from os.path import (dirname, basename, exists)
 from errno import ENOENT
 from urllib2 import HTTPError
 from locale import getpreferredencoding
+from time import (mktime, gmtime)
+from tempfile import SpooledTemporaryFile
+from StringIO import StringIO
 import osc.conf
 import osc.core
 try:
     from xml.etree import cElementTree as ET
 except ImportError:
     import cElementTree as ET
-from bsgit.bscache import BuildServiceCache, compute_srcmd5, check_proc
+from bsgit.bscache import BuildServiceCache, compute_srcmd5, check_proc, \
+			  unpack_manifest
+from bsgit.storage import open_storage, TABLES
+from bsgit.catfile import GitCatFile, BlobFile, parse_tree
+from bsgit.fastimport import GitFastImport
+from bsgit.workers import run_parallel, dependency_levels, prefetch
+from bsgit.transport import HTTPTransport, RecordingFile
+from bsgit.history import History, Revision
+from bsgit.sharedcache import SharedCache
 
 import pdb  # Python Debugger
 #pdb.set_trace()
@@ -49,10 +63,21 @@ opt_git = 'git'
 opt_force = False
 opt_verbose = False
 opt_apiurl = None
+opt_jobs = 4
+opt_max_connections = 8
+opt_plan = False
+opt_recheck = False
+opt_prefetch = 4
+opt_shared_cache = None
+opt_shared_cache_size = 4096
 
 #-----------------------------------------------------------------------
 
 bscache = None
+catfile = None
+importer = None
+transport = None
+shared_cache = None
 
 #=======================================================================
 
@@ -91,6 +116,20 @@ def get_rev_info(rev):
     except:
 	raise IOError('Cannot determine the project and package of ' + rev)
 
+def get_credentials(apiurl):
+    """Return the user name and password for apiurl from .oscrc."""
+    options = osc.conf.config['api_host_options'].get(apiurl, {})
+    return options.get('user'), options.get('pass')
+
+def get_ssl_context(apiurl):
+    """Return the SSL context for apiurl according to the sslcertck, cafile
+    and capath options in .oscrc."""
+    options = osc.conf.config['api_host_options'].get(apiurl, {})
+    if str(options.get('sslcertck', True)).lower() in ('0', 'false', 'no'):
+	return ssl._create_unverified_context()
+    return ssl.create_default_context(cafile=options.get('cafile'),
+				      capath=options.get('capath'))
+
 def git_get_sha1(branch):
     """Get the SHA1 hash of the head of the specified branch."""
     try:
@@ -99,38 +138,23 @@ def git_get_sha1(branch):
     except EnvironmentError:
 	return None
 
-def git_get_commit(sha1):
-    info = {}
-    cmd = [opt_git, 'cat-file', 'commit', sha1]
+def git_get_commits(sha1, exclude=None):
+    """Read the commits reachable from sha1 (but not from exclude) with a
+    single git rev-list.  Returns a dict mapping each commit to a (parents,
+    author email, message) tuple."""
+    cmd = [opt_git, 'rev-list', '--format=%P%n%ae%n%B%x00', sha1]
+    if exclude != None:
+	cmd.append('^' + exclude)
     proc = subprocess.Popen(cmd, stdout=PIPE)
-    while True:
-	line = proc.stdout.readline()
-	if line == '':
-	    break
-	elif line == '\n':
-	    info['message'] = proc.stdout.read().rstrip('\n')
-	    break
-	else:
-	    token, value = line.rstrip('\n').split(' ', 1)
-	    if token == 'tree':
-		if token in info:
-		    raise IOError("Commit %s: parse error in headers" % sha1)
-		info[token] = value
-	    elif token == 'parent':
-		if 'parents' not in info:
-		    info['parents'] = []
-	        info['parents'].append(value)
-	    elif token in ('author', 'committer'):
-	        match = re.match('(.*) <([^<>]+)> (\d+) ([-+]\d{4})$', value)
-		if not match or token in info:
-		    raise IOError("Commit %s: parse error in headers" % sha1)
-		name, email, time, timezone = match.groups()
-		info[token] = {'name': name, 'email': email, 'time': time,
-			       'timezone': timezone}
-	    else:
-		raise IOError("Commit %s: parse error in headers" % sha1)
+    output = proc.communicate()[0]
     check_proc(proc, cmd)
-    return info
+    commits = {}
+    for record in output.split('\0\n'):
+	if record == '':
+	    continue
+	header, parents, email, message = record.split('\n', 3)
+	commits[header[7:]] = (parents.split(), email, message.rstrip('\n'))
+    return commits
 
 def git_abbrev_rev(rev):
     """If rev is a SHA1 hash, return an abbreviated version."""
@@ -141,13 +165,9 @@ def git_abbrev_rev(rev):
 
 def git_list_tree(commit_sha1):
     """Return the list of files in commit_sha1, with their SHA1 hashes."""
-    # FIXME: Use NUL-terminated format (-z) for newlines in filenames.
-    cmd = [opt_git, 'ls-tree', commit_sha1]
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    data = catfile.read(commit_sha1 + '^{tree}', 'tree')
     files = []
-    for line in proc.stdout:
-	mode, type, sha1, name = \
-	    re.match('^(\d{6}) ([^ ]+) ([0-9a-f]{40})\t(.*)', line).groups()
+    for mode, type, sha1, name in parse_tree(data):
 	if type == 'blob':
 	    files.append({'mode': mode, 'name': name, 'sha1': sha1})
 	elif type == 'tree':
@@ -164,11 +184,69 @@ def get_xml_root(apiurl, rel, query=None):
     """Run a build service query and return the XML root element
     of the result.
     """
+    return get_xml(apiurl, rel, query, lambda file: ET.parse(file).getroot())
+
+def get_xml(apiurl, rel, query, parse, immutable=False):
+    """Run a build service query and return the result of PARSE, which
+    is called with a file to parse the response from as it arrives.
+
+    Responses are kept in bscache ('response <server>/<path>?<query>').
+    Responses of immutable queries are never requested again; others are
+    kept if the server sends an ETag or Last-Modified header, and are
+    revalidated with a conditional request.
+    """
+    url = osc.core.makeurl(apiurl, rel, query)
+    key = 'response ' + re.sub('.*://', '', url)
+    validators = ('', '')
+    try:
+	value = bscache[key].split('\n', 1)
+	body = value[1]
+	if immutable:
+	    return parse(StringIO(body))
+	validators = tuple(value[0].split('\t'))
+    except KeyError:
+	pass
+    response = get_response(apiurl, rel, query, validators, parse, True)
+    if response == None:
+	return parse(StringIO(body))
+    result, body, validators = response
+    if immutable or validators != ('', ''):
+	bscache[key] = '\t'.join(validators) + '\n' + body
+    return result
+
+def get_response(apiurl, rel, query, validators, parse, record=False):
+    """Make a GET request, conditional on the (etag, last_modified)
+    validators of an earlier response if there are any, and parse the
+    response with PARSE.  Returns the result of PARSE, the response body
+    (if RECORD is set) and its validators, or None if the earlier
+    response is still current.
+    """
     url = osc.core.makeurl(apiurl, rel, query)
+    etag, last_modified = validators
+    headers = {}
+    if etag:
+	headers['If-None-Match'] = etag
+    if last_modified:
+	headers['If-Modified-Since'] = last_modified
     if opt_verbose:
 	print "-- GET " + url
-    file = osc.core.http_GET(url)
-    return ET.parse(file).getroot()
+    file = transport.get(url, headers)
+    try:
+	if file.status == 304:
+	    file.read()
+	    return None
+	validators = (file.getheader('etag', ''),
+		      file.getheader('last-modified', ''))
+	if record:
+	    recording = RecordingFile(file)
+	    result = parse(recording)
+	    recording.read()
+	    return result, recording.getvalue(), validators
+	result = parse(file)
+	file.read()
+	return result, None, validators
+    finally:
+	file.close()
 
 #-----------------------------------------------------------------------
 
@@ -201,16 +279,31 @@ def map_login_to_user(apiurl, login):
 
 def map_email_to_login(apiurl, email):
     """Map an email address to a build service account name."""
-    if email == 'UNKNOWN':
-	return 'unknown'
-    elif email == 'BUILDSERVICE-AUTOCOMMIT':
-	return 'buildservice-autocommit'
-    try:
-	login = bscache['login ' + email]
-	return login
-    except KeyError:
+    return map_emails_to_logins(apiurl, [email])[email]
+
+def map_emails_to_logins(apiurl, emails):
+    """Map email addresses to build service account names, with a single
+    cache lookup.  Returns a dict."""
+    special = {'UNKNOWN': 'unknown',
+	       'BUILDSERVICE-AUTOCOMMIT': 'buildservice-autocommit'}
+    logins = {}
+    keys = []
+    for email in set(emails):
+	if email in special:
+	    logins[email] = special[email]
+	else:
+	    keys.append('login ' + email)
+    for key, login in bscache.get_many(keys).items():
+	logins[key[6:]] = login
+    unknown = sorted([key[6:] for key in keys if key[6:] not in logins])
+    if len(unknown) == 1:
 	raise IOError("Cannot map email '%s' to a build service account name. "
-		      "Please use the usermap command." % email)
+		      "Please use the usermap command." % unknown[0])
+    elif unknown:
+	raise IOError("Cannot map emails %s to build service account names. "
+		      "Please use the usermap command." %
+		      ', '.join(["'%s'" % email for email in unknown]))
+    return logins
 
 def get_user_info(apiurl, login):
     """Retrieve a build service user's details (email and realname).
@@ -298,42 +391,76 @@ def get_package_status(apiurl, project, package, **what):
 	what = {'rev': 'latest'}
     status = get_new_package_status(apiurl, project, package, what)
     if 'rev' in status:
-	if 'rev' not in what or what['rev'] == 'latest':
-	    what['rev'] = status['rev']
 	key = server + '/' + project + '/' + package
 	if key not in get_package_status.status:
 	    get_package_status.status[key] = {}
-	get_package_status.status[key][tuple(what.items())] = status
+	statuses = get_package_status.status[key]
+	# Remember the status under what was asked for, and under the actual
+	# revision (forget_about_latest_revision() drops the 'latest' keys).
+	statuses[tuple(what.items())] = status
+	if 'rev' not in what or what['rev'] == 'latest':
+	    what = dict(what)
+	    what['rev'] = status['rev']
+	    statuses[tuple(what.items())] = status
     return status
 get_package_status.status = {}
 
-def parse_xml_directory(root):
+def iter_directory(file):
+    """Parse a directory document as it is read.  Yields ('directory',
+    attributes) first, and then (tag, attributes) for each linkinfo and
+    entry element.  No tree of the document is kept.
+    """
+    depth = 0
+    for event, node in ET.iterparse(file, ('start', 'end')):
+	if event == 'start':
+	    if depth == 0:
+		root = node
+		yield node.tag, dict(node.attrib)
+	    depth += 1
+	    continue
+	depth -= 1
+	if depth == 1:
+	    if node.tag in ('linkinfo', 'entry'):
+		yield node.tag, dict(node.attrib)
+	    # Also drop the element from the root element.
+	    root.clear()
+
+def parse_xml_directory(file):
     status = {}
-    for name in ('rev', 'srcmd5', 'xsrcmd5'):
-	value = root.get(name)
-	if value != None:
-	    status[name] = value
-    node = root.find('linkinfo')
-    if node != None:
-	linkinfo = {}
-	for name in ('project', 'package', 'baserev', 'srcmd5', 'lsrcmd5', 'rev'):
-	    value = node.get(name)
-	    if value != None:
-		linkinfo[name] = value
-	status['linkinfo'] = linkinfo
     files = []
-    for node in root.findall('entry'):
-	file = {}
-	file['name'] = node.get('name')
-	file['md5'] = node.get('md5')
-	files.append(file)
+    for tag, attributes in iter_directory(file):
+	if tag == 'linkinfo':
+	    linkinfo = {}
+	    for name in ('project', 'package', 'baserev', 'srcmd5', 'lsrcmd5',
+			 'rev'):
+		if name in attributes:
+		    linkinfo[name] = attributes[name]
+	    status['linkinfo'] = linkinfo
+	elif tag == 'entry':
+	    file = {}
+	    file['name'] = attributes.get('name')
+	    file['md5'] = attributes.get('md5')
+	    files.append(file)
+	else:
+	    for name in ('rev', 'srcmd5', 'xsrcmd5', 'error'):
+		if name in attributes:
+		    status[name] = attributes[name]
     status['files'] = files
     return status
 
+def is_immutable_status(what):
+    """Check if the status of a package queried with WHAT can never change:
+    the status of a srcmd5 is fixed unless it is expanded against the
+    current revision of the link target."""
+    srcmd5 = '^[0-9a-f]{32}$'
+    if not re.match(srcmd5, what.get('rev', '')):
+	return False
+    return 'expand' not in what or \
+	   re.match(srcmd5 + '|^base$', what.get('linkrev', '')) != None
+
 def get_new_package_status(apiurl, project, package, what):
-    root = get_xml_root(apiurl, ['source', project, package], what)
-    status = parse_xml_directory(root)
-    return status
+    return get_xml(apiurl, ['source', project, package], what,
+		   parse_xml_directory, immutable=is_immutable_status(what))
 
 #-----------------------------------------------------------------------
 
@@ -355,21 +482,26 @@ def get_revision(apiurl, project, package, rev='latest'):
 	...
       </revisionlist>
 
-    Returns:
-    {'rev': ..., 'srcmd5': ..., 'time': ..., 'user': ..., 'comment': ...,
-     'parent': {'srcmd5': ..., ...}}
+    Returns the Revision, or None.
     """
+    return get_history(apiurl, project, package).lookup(rev)
+
+def get_history(apiurl, project, package):
+    """Return the History of a package."""
     server = re.sub('.*://', '', apiurl)
     key = server + '/' + project + '/' + package
     try:
-	history = get_revision.history[key]
-    except KeyError:
-	history = get_revisions(apiurl, project, package)
-	get_revision.history[key] = history
-    try:
-	return history[rev]
+	# (Without taking the package lock if we can.)
+	return get_revision.history[key]
     except KeyError:
-	return None
+	pass
+    with package_lock(apiurl, project, package):
+	try:
+	    return get_revision.history[key]
+	except KeyError:
+	    history = get_revisions(apiurl, project, package)
+	    get_revision.history[key] = history
+	    return history
 get_revision.history = {}
 
 def forget_about_latest_revision(apiurl, project, package):
@@ -389,49 +521,117 @@ def get_revision_key(apiurl, project, package, rev):
     server = re.sub('.*://', '', apiurl)
     return 'revision ' + server + '/' + project + '/' + package + '/' + rev
 
+HISTORY_FIELDS = ('rev', 'srcmd5', 'time', 'user', 'comment')
+
+def get_history_records(apiurl, project, package):
+    """Return the history of a package as a list of revision records
+    (tuples of the HISTORY_FIELDS, with None for missing fields), oldest
+    first.
+
+    The records are kept in bscache ('history <server>/<project>/<package>')
+    together with the validators of the _history response, so an unchanged
+    history is not downloaded again, and only new revisions are parsed.
+    """
+    server = re.sub('.*://', '', apiurl)
+    key = 'history ' + server + '/' + project + '/' + package
+    try:
+	validators, records = parse_history_value(bscache[key])
+    except (KeyError, ValueError):
+	validators, records = ('', ''), []
+    known = records
+    response = get_response(apiurl, ['source', project, package, '_history'],
+			    None, validators,
+			    lambda file: list(iter_revisionlist(file, known)))
+    if response != None:
+	records, body, validators = response
+	bscache[key] = format_history_value(validators, records)
+    return records
+
+def format_history_value(validators, records):
+    """Format the validators and records of a history as text: the
+    validators on the first line, and then one line per record with
+    tab-separated fields.  Special characters are backslash escaped, and
+    missing fields are written as \\N."""
+    lines = ['\t'.join(validators)]
+    for record in records:
+	fields = []
+	for value in record:
+	    if value == None:
+		fields.append('\\N')
+	    else:
+		if isinstance(value, unicode):
+		    value = value.encode('UTF-8')
+		fields.append(value.encode('string_escape'))
+	lines.append('\t'.join(fields))
+    return '\n'.join(lines)
+
+def parse_history_value(value):
+    """The reverse of format_history_value().  Raises ValueError for values
+    in an unknown format."""
+    lines = value.split('\n')
+    validators = tuple(lines[0].split('\t'))
+    if len(validators) != 2:
+	raise ValueError('Invalid history value')
+    records = []
+    for line in lines[1:]:
+	fields = line.split('\t')
+	if len(fields) != len(HISTORY_FIELDS):
+	    raise ValueError('Invalid history value')
+	record = []
+	for field in fields:
+	    if field == '\\N':
+		record.append(None)
+		continue
+	    field = field.decode('string_escape')
+	    try:
+		field.decode('ascii')
+	    except UnicodeDecodeError:
+		# ElementTree returns non-ASCII text as unicode.
+		field = field.decode('UTF-8')
+	    record.append(field)
+	records.append(tuple(record))
+    return validators, records
+
+def iter_revisionlist(file, known=[]):
+    """Parse a _history revisionlist as it is read, and yield a revision
+    record for each revision.  As long as the revisions are the same as in
+    KNOWN (the records of an earlier version of the same history, compared
+    by rev and srcmd5), the known records are used instead of parsing the
+    revisions again.  No tree of the document is kept."""
+    n = 0
+    root = None
+    for event, node in ET.iterparse(file, ('start', 'end')):
+	if root == None:
+	    root = node
+	if event != 'end' or node.tag != 'revision':
+	    continue
+	if n < len(known) and node.get('rev') == known[n][0] and \
+	   node.findtext('srcmd5') == known[n][1]:
+	    record = known[n]
+	else:
+	    known = []
+	    record = [node.get('rev')]
+	    for name in HISTORY_FIELDS[1:]:
+		value = node.find(name)
+		if value != None:
+		    value = value.text
+		record.append(value)
+	    record = tuple(record)
+	# Drop the revision from the root element.
+	root.clear()
+	n += 1
+	yield record
+
 def get_revisions(apiurl, project, package):
-    root = get_xml_root(apiurl, ['source', project, package, '_history'])
-
-    head = None
-    history = {}
-    need_to_fetch = False
-    for node in root.findall('revision'):
-	revision = {}
-	revision['rev'] = node.get('rev')
-	for name in ('srcmd5', 'time', 'user', 'comment'):
-	    value = node.find(name)
-	    if value != None and value.text != None:
-		revision[name] = value.text
-
-	if head:
-	    revision['parent'] = head
-	head = revision
-	rev = revision['rev']
-	history[rev] = head
-
-	# Index by srcmd5 as well.  (It is possibe that more than one revision
-	# has the same srcmd5.  In that case, map from this srcmd5 to the
-	# first such revision.)
-	srcmd5 = revision['srcmd5']
-	if srcmd5 not in history:
-	    history[srcmd5] = head
-
-	# Figure out if this revision is known already.  If it is, we need
-	# to connect to it when fetching descendants.
-	if need_to_fetch:
-	    head['need_to_fetch'] = True
-	revision_key = get_revision_key(apiurl, project, package, rev)
-	try:
-	    if not opt_force:
-		commit_sha1 = bscache[revision_key]
-		head['commit_sha1'] = commit_sha1
-		need_to_fetch = True
-	except KeyError:
-	    pass
+    # Look up which revisions are known already in one go.
+    known = {}
+    if not opt_force:
+	prefix = get_revision_key(apiurl, project, package, '')
+	with bscache.lock:
+	    for key, commit_sha1 in bscache.iter_prefix(prefix):
+		known[key[len(prefix):]] = commit_sha1
 
-    if head:
-	history['latest'] = head
-    return history
+    return History(get_history_records(apiurl, project, package), known)
 
 #=======================================================================
 
@@ -451,139 +651,165 @@ def guess_link_target(apiurl, project, package, rev, linkinfo, time, silent=Fals
 	lpackage = linkinfo['package']
 	if 'rev' in linkinfo:
 	    trevision = get_revision(apiurl, lproject, lpackage, rev=linkinfo['rev'])
-	    return trevision['srcmd5']
+	    return trevision.srcmd5
 	else:
+	    # Guesses are remembered in bscache.
+	    server = re.sub('.*://', '', apiurl)
+	    key = 'baserev %s/%s/%s/%s' % (server, project, package, rev)
 	    try:
-		trevision = get_revision(apiurl, lproject, lpackage)
-		while time < trevision['time']:
-		    trevision = trevision['parent']
-		if not silent:
-		    print >>stderr, "Warning: %s/%s (%s): link target " \
-				    "guessed as %s(%s) based on timestamps." % \
-				    (project, package, rev, lpackage,
-				     trevision['srcmd5'])
-		return trevision['srcmd5']
+		srcmd5 = bscache[key]
 	    except KeyError:
-		return None
+		history = get_history(apiurl, lproject, lpackage)
+		trevision = history.lookup_time(time)
+		if trevision == None:
+		    return None
+		srcmd5 = trevision.srcmd5
+		if rev != 'latest':
+		    bscache[key] = srcmd5
+	    if not silent:
+		print >>stderr, "Warning: %s/%s (%s): link target " \
+				"guessed as %s(%s) based on timestamps." % \
+				(project, package, rev, lpackage, srcmd5)
+	    return srcmd5
 
 #-----------------------------------------------------------------------
 
 def fetch_files(apiurl, project, package, srcmd5, files):
-    """Fetch a list of files from the specified package."""
+    """Fetch a list of files from the specified package.  Files which are
+    not known yet are downloaded in parallel (each distinct md5 only once),
+    and then added to git in order.  Files which prefetch_revision() is
+    still downloading are waited for."""
+    missing = []
+    seen = set()
     for file in files:
-	sha1 = fetch_file(apiurl, project, package, srcmd5,
-			  file['name'], file['md5'])
-	file['sha1'] = sha1
-
-def fetch_file(apiurl, project, package, srcmd5, name, md5):
-    """Fetch a file (unless it is already known)."""
-    try:
-	sha1 = bscache['blob ' + md5]
-    except KeyError:
-	sha1 = fetch_new_file(apiurl, project, package, srcmd5, name, md5)
-	bscache['blob ' + md5] = sha1
-    return sha1
-
-def fetch_new_file(apiurl, project, package, srcmd5, name, md5):
-    """Fetch a file.
+	md5 = file['md5']
+	if md5 not in seen and not bscache.has_key('blob ' + md5):
+	    missing.append(file)
+	seen.add(md5)
+
+    def download(file):
+	# The file may have been downloaded ahead of time already, or may
+	# be on its way.
+	with fetch_files.lock:
+	    while file['md5'] in fetch_files.prefetching:
+		fetch_files.prefetched_one.wait()
+	    download = fetch_files.prefetched.pop(file['md5'], None)
+	if download != None:
+	    return download
+	return download_file(apiurl, project, package, srcmd5,
+			     file['name'], file['md5'])
+    downloads = run_parallel(download, missing, opt_jobs)
+
+    for file, (tmp, size) in zip(missing, downloads):
+	bscache['blob ' + file['md5']] = importer.blob(tmp, size)
+	tmp.close()
+    for file in files:
+	file['sha1'] = bscache['blob ' + file['md5']]
+# Files downloaded by prefetch_revision(): {md5: (tmp, size)}, and the
+# files which prefetch_revision() is downloading right now.  The condition
+# is notified whenever one of those downloads finishes or fails.
+fetch_files.prefetched = {}
+fetch_files.prefetching = set()
+fetch_files.lock = threading.Lock()
+fetch_files.prefetched_one = threading.Condition(fetch_files.lock)
+
+def download_file(apiurl, project, package, srcmd5, name, md5):
+    """Download a file into a temporary file and verify its checksum.
+    (fast-import needs to know the size of a blob before its contents.)
 
     https://api.opensuse.org/source/PROJECT/PACKAGE/FILE&rev=REV
+
+    Returns the temporary file, positioned at the start, and its size.
+    With a shared cache, files are taken from there if possible, and
+    downloaded files are added to it.
     """
+    if shared_cache:
+	cached = shared_cache.lookup(md5)
+	if cached:
+	    return cached
     query = 'rev=' + srcmd5
     url = osc.core.makeurl(apiurl,
 			   ['source', project, package, name],
 			   query=query)
     if opt_verbose:
 	print "-- GET " + url
-    file = osc.core.http_GET(url)
-    cmd = [opt_git, 'hash-object', '-w', '--stdin']
-    proc = subprocess.Popen(cmd, stdin=PIPE, stdout=PIPE)
-    hasher = hashlib.md5()
-    while True:
-	data = file.read(16384)
-	if len(data) == 0:
-	    break
-	proc.stdin.write(data)
-	hasher.update(data)
-    if hasher.hexdigest() != md5:
-	proc.kill()
-	raise IOError('MD5 checksum mismatch')
-    proc.stdin.close()
-    sha1 = proc.stdout.read().rstrip('\n')
-    check_proc(proc, cmd)
-    return sha1
-
-def create_tree(files):
-    """Create a git tree object from a list of files."""
-    # FIXME: Use NUL-terminated format (-z) for newlines in filenames.
-    cmd = [opt_git, 'mktree']
-    proc = subprocess.Popen(cmd, stdin=PIPE, stdout=PIPE)
-    for file in sorted(files, cmp=lambda a,b: cmp(a['name'], b['name'])):
-	line = '100644 blob %s\t%s\n' % (file['sha1'], file['name'])
-        proc.stdin.write(line)
-    proc.stdin.close()
-    tree_sha1 = proc.stdout.read().rstrip('\n')
-    check_proc(proc, cmd)
-    return tree_sha1
-
-def create_commit(apiurl, tree_sha1, revision, parents):
-    """Create a git commit from a tree object and a build service revision."""
-    cmd = [opt_git, 'commit-tree', tree_sha1]
-    for commit_sha1 in parents:
-	cmd.extend(['-p', commit_sha1])
-
+    file = transport.get(url)
+    if shared_cache:
+	tmp = shared_cache.new_file()
+    else:
+	tmp = SpooledTemporaryFile(max_size=1 << 20)
     try:
-	user = revision['user']
-    except KeyError:
-	user = 'unknown'
-    if user == '_service':
+	hasher = hashlib.md5()
+	size = 0
+	while True:
+	    data = file.read(16384)
+	    if len(data) == 0:
+		break
+	    tmp.write(data)
+	    hasher.update(data)
+	    size += len(data)
+	if hasher.hexdigest() != md5:
+	    raise IOError('MD5 checksum mismatch')
+    except:
+	if shared_cache:
+	    shared_cache.discard(tmp)
+	raise
+    if shared_cache:
+	shared_cache.add(md5, tmp)
+    tmp.seek(0)
+    return tmp, size
+
+def git_date(time):
+    """Format a build service timestamp the way git would for
+    GIT_AUTHOR_DATE=<time>, i.e., in the local timezone."""
+    seconds = int(time)
+    offset = (seconds - int(mktime(gmtime(seconds)[:8] + (-1,)))) / 60
+    if offset < 0:
+	sign = '-'
+	offset = -offset
+    else:
+	sign = '+'
+    return '%d %s%02d%02d' % (seconds, sign, offset / 60, offset % 60)
+
+def create_commit(apiurl, tree, revision, parents):
+    """Create a git commit from a tree and a build service revision.  TREE
+    is the SHA1 hash of an existing tree or a list of fetched files.
+    Returns the SHA1 hashes of the commit and its tree.
+    """
+    user = revision.user
+    if user == None or user == '_service':
         user = 'unknown'
 
     encoding = getpreferredencoding()
 
     name, email = map_login_to_user(apiurl, user)
-    time = revision['time']
-    environ['GIT_AUTHOR_NAME'] = name.encode(encoding)
-    environ['GIT_COMMITTER_NAME'] = name.encode(encoding)
-    environ['GIT_AUTHOR_EMAIL'] = email.encode(encoding)
-    environ['GIT_COMMITTER_EMAIL'] = email.encode(encoding)
-    environ['GIT_AUTHOR_DATE'] = time
-    environ['GIT_COMMITTER_DATE'] = time
-    proc = subprocess.Popen(cmd, stdin=PIPE, stdout=PIPE)
-    if 'comment' in revision:
-	proc.stdin.write(revision['comment'])
-    proc.stdin.close()
-    commit_sha1 = proc.stdout.read().rstrip('\n')
-    check_proc(proc, cmd)
-    return commit_sha1
+    ident = '%s <%s> %s' % (name.encode(encoding), email.encode(encoding),
+			    git_date(revision.time))
+    message = revision.comment or ''
+    if isinstance(message, unicode):
+	message = message.encode('UTF-8')
+    return importer.commit(tree, parents, ident, ident, message)
 
 def commit_is_a_parent(base_sha1, sha1):
-    info = git_get_commit(sha1)
-    if 'parents' in info:
-	for parent in info['parents']:
-	    if base_sha1 == parent or commit_is_a_parent(base_sha1, parent):
-		return True
-    return False
+    return bscache.is_ancestor(base_sha1, sha1)
 
 def fetch_revision(apiurl, project, package, revision, status):
     """Fetch one revision, including the files in it.
 
     Also used to fetch expanded / merged versions of packages; in this case,
-    revision['rev'] is unset, and revision['srcmd5'] defines which files to
+    revision.rev is unset, and revision.srcmd5 defines which files to
     fetch.
     """
-    try:
-	rev_or_srcmd5 = revision['rev']
-    except KeyError:
-	rev_or_srcmd5 = revision['srcmd5']
+    rev_or_srcmd5 = revision.rev or revision.srcmd5
     revision_key = get_revision_key(apiurl, project, package, rev_or_srcmd5)
     try:
 	commit_sha1 = bscache[revision_key]
     except KeyError:
 	print "Fetching %s/%s (%s)" % (project, package, rev_or_srcmd5)
 	srcmd5 = status['srcmd5']
+	files = None
 	try:
-	    tree_sha1 = bscache['tree ' + srcmd5]
+	    tree = bscache['tree ' + srcmd5]
 	except KeyError:
 	    files = status['files']
 	    # Note: for links, the srcmd5 hash we get does not match the
@@ -591,28 +817,31 @@ def fetch_revision(apiurl, project, package, revision, status):
 	    #if compute_srcmd5(files) != srcmd5:
 	    #	raise IOError('MD5 checksum mismatch')
 	    fetch_files(apiurl, project, package, srcmd5, files)
-	    tree_sha1 = create_tree(files)
-	    bscache['tree ' + srcmd5] = tree_sha1
+	    tree = files
 
 	parents = []
-	if 'parent' in revision:
-	    parent = revision['parent']
-	    if 'commit_sha1' in parent:
-		parents.append(parent['commit_sha1'])
-	if 'base_sha1' in revision:
-	    base_sha1 = revision['base_sha1']
+	parent = revision.parent()
+	if parent != None and parent.commit_sha1 != None:
+	    parents.append(parent.commit_sha1)
+	if revision.base_sha1 != None:
+	    base_sha1 = revision.base_sha1
 	    if len(parents) == 0 or \
 	       not commit_is_a_parent(base_sha1, parents[0]):
 		parents.append(base_sha1)
 
-	commit_sha1 = create_commit(apiurl, tree_sha1, revision, parents)
+	commit_sha1, tree_sha1 = create_commit(apiurl, tree, revision, parents)
+	bscache.add_to_graph(commit_sha1, parents)
+	bscache['tree ' + srcmd5] = tree_sha1
+	if files != None:
+	    bscache.add_manifest(tree_sha1, [(file['name'], file['md5'])
+					     for file in files])
 	bscache[revision_key] = commit_sha1
 
 	# Add a sentinel which tells us that the MD5 hashes of the objects
 	# in this commit are in bscache.  This stops bscache.update() from
 	# re-hashing this commit.
 	bscache['commit ' + commit_sha1] = tree_sha1
-    revision['commit_sha1'] = commit_sha1
+    revision.commit_sha1 = commit_sha1
     if opt_verbose:
 	print "Storing %s/%s (%s) as %s" % (project, package, rev_or_srcmd5,
 					    git_abbrev_rev(commit_sha1))
@@ -620,8 +849,8 @@ def fetch_revision(apiurl, project, package, revision, status):
 
 def refers_to_parents_only(apiurl, project, package, srcmd5, child_sha1):
     revision = get_revision(apiurl, project, package, srcmd5)
-    if revision != None and 'commit_sha1' in revision:
-	return commit_is_a_parent(revision['commit_sha1'], child_sha1)
+    if revision != None and revision.commit_sha1 != None:
+	return commit_is_a_parent(revision.commit_sha1, child_sha1)
 
     status = get_package_status(apiurl, project, package, rev=srcmd5)
     if 'linkinfo' in status:
@@ -657,7 +886,6 @@ def fetch_base_rec(apiurl, project, package, srcmd5, depth):
 	revision = None
 
     if revision != None:
-	rev = revision['rev']
 	commit_sha1 = fetch_revision_rec(apiurl, project, package, revision,
 					 depth - 1)
     else:
@@ -670,146 +898,276 @@ def fetch_base_rec(apiurl, project, package, srcmd5, depth):
 	fetch_revision_rec(apiurl, lproject, lpackage, parent, depth - 1)
 	base_sha1 = fetch_base_rec(apiurl, lproject, lpackage,
 				   linkinfo['srcmd5'], depth - 1)
-	revision = {
-	    'srcmd5': srcmd5,
-	    'parent': parent,
-	    'base_sha1': base_sha1,
-	    'time': parent['time'],
-	    'comment': 'Expanded %s(%s)' % (package, parent['rev']),
-	    }
-	for name in ('user', 'time'):
-	    if name in parent:
-		revision[name] = parent[name]
+	revision = Revision(parent.history, parent.history.rev_index[parent.rev],
+			    srcmd5=srcmd5, time=parent.time, user=parent.user,
+			    comment='Expanded %s(%s)' % (package, parent.rev))
+	revision.base_sha1 = base_sha1
 	commit_sha1 = fetch_revision(apiurl, project, package, revision, status)
 
     # Make sure we also have the most recent revisions of the link package
     fetch_package(apiurl, project, package)
     return commit_sha1
 
-def get_base_status(apiurl, project, package, rev='latest'):
+def get_expanded_status(apiurl, project, package, rev, linkrev):
+    """Retrieve the status of a revision expanded against linkrev, or None
+    if the build service cannot expand it (404).
+
+    Expansions which failed are remembered in bscache ('missing <server>/
+    <project>/<package>/<rev>?linkrev=<linkrev>', with the time of the
+    failure) and are not requested again until the entry is thirty days
+    old, or with --recheck.
+    """
+    server = re.sub('.*://', '', apiurl)
+    key = 'missing %s/%s/%s/%s?linkrev=%s' % \
+	  (server, project, package, rev, linkrev)
+    if not opt_recheck:
+	try:
+	    if time.time() - int(bscache[key]) < 30 * 24 * 60 * 60:
+		get_expanded_status.saved += 1
+		return None
+	except KeyError:
+	    pass
     try:
 	status = get_package_status(apiurl, project, package, rev=rev,
-				    linkrev='base', expand='1')
-	expanded = True
+				    linkrev=linkrev, expand='1')
     except HTTPError, error:
-	if error.code == 404:
-	    # Most likely, this is an old revision that does not have the
-	    # baserev attribute.  Query the unexpanded status; we will try
-	    # our best below.
-	    status = get_package_status(apiurl, project, package, rev=rev)
-	    expanded = False
-	else:
+	if error.code != 404:
 	    raise
+	if rev != 'latest':
+	    bscache[key] = str(int(time.time()))
+	return None
+    if opt_recheck and bscache.has_key(key):
+	del bscache[key]
+    return status
+get_expanded_status.saved = 0
+
+def get_base_status(apiurl, project, package, rev='latest', silent=False):
+    status = get_expanded_status(apiurl, project, package, rev, 'base')
+    expanded = status != None
+    if not expanded:
+	# Most likely, this is an old revision that does not have the
+	# baserev attribute.  Query the unexpanded status; we will try
+	# our best below.
+	status = get_package_status(apiurl, project, package, rev=rev)
     if 'linkinfo' in status:
 	linkinfo = status['linkinfo']
+	if silent and 'baserev' not in linkinfo:
+	    # Leave the remembered status alone, or the guess below would not
+	    # be reported when the revision is fetched.
+	    status = dict(status)
+	    linkinfo = dict(linkinfo)
+	    status['linkinfo'] = linkinfo
 	lproject = linkinfo['project']
 	lpackage = linkinfo['package']
 	revision = get_revision(apiurl, project, package, rev)
 	baserev = guess_link_target(apiurl, project, package, rev, linkinfo,
-				    revision['time'])
+				    revision.time, silent)
 	if baserev != None:
 	    if not expanded:
 		# This revisision hasn't been expanded against linkrev='base'
 		# (probably because it doesn't have a baserev tag), and we have
 		# guessed a baserev now.
-		try:
-		    status = get_package_status(apiurl, project, package,
-						rev=rev, linkrev=baserev,
-						expand='1')
-		except HTTPError, error:
-		    if error.code == 404:
-			print >>stderr, "Warning: %s/%s (%s): cannot expand" % \
-					(project, package, rev)
-		    else:
-			raise
+		expanded_status = get_expanded_status(apiurl, project, package,
+						      rev, baserev)
+		if expanded_status != None:
+		    status = expanded_status
+		elif not silent:
+		    print >>stderr, "Warning: %s/%s (%s): cannot expand" % \
+				    (project, package, rev)
 	    if 'baserev' not in linkinfo:
 		linkinfo['baserev'] = baserev
     return status
 
 def fetch_revision_rec(apiurl, project, package, revision, depth):
-    """Fetch a revision and its children, up to the defined maximum depth.
+    """Fetch a revision and its parents, up to the defined maximum depth.
     Reconnect to parents further up the tree if they are already known.
-    """
-    if 'parent' in revision and (depth > 1 or 'need_to_fetch' in revision):
-	parent = revision['parent']
-	commit_sha1 = fetch_revision_rec(apiurl, project, package, parent,
-					 depth - 1)
-	parent['commit_sha1'] = commit_sha1
 
-    try:
-	commit_sha1 = revision['commit_sha1']
-	# Apparently, we have this revision already.
-	return commit_sha1
-    except KeyError:
-	pass
+    The revisions to fetch are collected first, and then fetched oldest
+    first.  Every 100 revisions, the progress is made permanent (see
+    checkpoint_package()), so an interrupted fetch resumes from there.
+    (Fetching the base of a link still recurses into the link target,
+    but only as deep as links are nested.)
 
-    base_status = get_base_status(apiurl, project, package, revision['rev'])
+    While git objects are created for one revision, the statuses and
+    files of the next revisions are downloaded in the background (see
+    prefetch_revision()).
+    """
+    with package_lock(apiurl, project, package):
+	prefetched = set()
+	def prefetch_queued(item):
+	    prefetch_revision(apiurl, project, package, item[0], prefetched)
+	queue = prefetch(prefetch_queued, revisions_to_fetch(revision, depth),
+			 opt_prefetch)
+	try:
+	    count = 0
+	    for queued, queued_depth in queue:
+		fetch_linked_revision(apiurl, project, package, queued,
+				      queued_depth)
+		count += 1
+		if count % 100 == 0:
+		    checkpoint_package(apiurl, project, package,
+				       queued.commit_sha1)
+	finally:
+	    queue.close()
+	    # Get rid of files which were downloaded but not used.
+	    for md5 in prefetched:
+		with fetch_files.lock:
+		    download = fetch_files.prefetched.pop(md5, None)
+		if download != None:
+		    download[0].close()
+	return revision.commit_sha1
+
+def prefetch_revision(apiurl, project, package, revision, prefetched):
+    """Query the status of a revision, and download the files that
+    fetch_revision() will need, ahead of time.  Up to --jobs files are
+    downloaded at the same time.  The MD5 hashes of the downloaded files
+    are added to PREFETCHED.
+
+    Only the linkrev=base expansion (or the unexpanded status) is looked
+    at: guessing link targets and fetching link bases needs package locks,
+    which must not be taken here.
+    """
+    status = get_expanded_status(apiurl, project, package, revision.rev,
+				 'base')
+    if status == None:
+	status = get_package_status(apiurl, project, package, rev=revision.rev)
+    if bscache.has_key('tree ' + status['srcmd5']):
+	return
+    # Other packages may be prefetching the same files.
+    files = []
+    with fetch_files.lock:
+	for file in status['files']:
+	    md5 = file['md5']
+	    if md5 in fetch_files.prefetched or \
+	       md5 in fetch_files.prefetching or \
+	       bscache.has_key('blob ' + md5):
+		continue
+	    fetch_files.prefetching.add(md5)
+	    files.append(file)
+
+    def download(file):
+	md5 = file['md5']
+	try:
+	    download = download_file(apiurl, project, package,
+				     status['srcmd5'], file['name'], md5)
+	    with fetch_files.lock:
+		fetch_files.prefetched[md5] = download
+		prefetched.add(md5)
+	finally:
+	    with fetch_files.lock:
+		fetch_files.prefetching.discard(md5)
+		fetch_files.prefetched_one.notify_all()
+    run_parallel(download, files, opt_jobs)
+
+def revisions_to_fetch(revision, depth):
+    """Walk back from a revision to the first known revision (or as deep as
+    needed).  Returns the revisions along the way together with their
+    depth, oldest first.  Revisions which are known already are left
+    out."""
+    queue = [(revision, depth)]
+    while True:
+	revision, depth = queue[-1]
+	parent = revision.parent()
+	if revision.commit_sha1 != None or parent == None or \
+	   (depth <= 1 and not revision.need_to_fetch):
+	    break
+	queue.append((parent, depth - 1))
+    queue.reverse()
+    return [(revision, depth) for revision, depth in queue
+	    if revision.commit_sha1 == None]
+
+def fetch_linked_revision(apiurl, project, package, revision, depth):
+    """Fetch a revision whose parent has been fetched already, and the base
+    revision of the link target if the revision is a link."""
+    parent = revision.parent()
+    base_status = get_base_status(apiurl, project, package, revision.rev)
     if 'linkinfo' in base_status:
 	linkinfo = base_status['linkinfo']
 	if 'baserev' in linkinfo:
 	    lproject = linkinfo['project']
 	    lpackage = linkinfo['package']
 	    baserev = linkinfo['baserev']
-	    try:
-		parent = revision['parent']
-	    except KeyError:
-		parent = None
-
-	    if parent == None or 'commit_sha1' not in parent or \
-	       not refers_to_parents_only(apiurl, lproject, lpackage,  baserev,
-					  parent['commit_sha1']):
-		base_sha1 = fetch_base_rec(apiurl, lproject, lpackage, baserev,
-					   depth - 1)
-		revision['base_sha1'] = base_sha1
-
-    commit_sha1 = fetch_revision(apiurl, project, package, revision, base_status)
-    return commit_sha1
+	    if parent == None or parent.commit_sha1 == None or \
+	       not refers_to_parents_only(apiurl, lproject, lpackage,
+					  baserev, parent.commit_sha1):
+		base_sha1 = fetch_base_rec(apiurl, lproject, lpackage,
+					   baserev, depth - 1)
+		revision.base_sha1 = base_sha1
+
+    return fetch_revision(apiurl, project, package, revision, base_status)
+
+def checkpoint_package(apiurl, project, package, commit_sha1):
+    """Make the revisions fetched so far permanent: write out the new git
+    objects, move the remote branch forward to COMMIT_SHA1 (unless that
+    would move it backwards), and commit bscache.  bscache must not refer
+    to objects which are not in the repository yet, so it is committed
+    last."""
+    remote_branch = remote_branch_name(apiurl, project, package)
+    sha1 = git_get_sha1(remote_branch)
+    if sha1 == None or bscache.is_ancestor(sha1, commit_sha1):
+	update_branch(remote_branch, commit_sha1)
+    else:
+	importer.checkpoint()
+    bscache.commit()
 
 def mark_as_needed_rec(rev, revision):
     """Mark all revisions up the rev as needed."""
     # FIXME: If we end up further back in the history than any known revisions,
-    # we need to refetch all the revisions.  (Unset all the 'commit-sha1's in
+    # we need to refetch all the revisions.  (Unset all the commit_sha1s in
     # that case!)
-    if revision['rev'] == rev or \
-       ('parent' in revision and
-        mark_as_needed_rec(rev, revision['parent'])):
-	revision['need_to_fetch'] = True
-	return True
-    return False
+    return revision.history.mark_as_needed(rev, revision)
 
 def fetch_package(apiurl, project, package, depth=sys.maxint, need_rev=None,
 		  check_uptodate=True):
     """Fetch a package, up to the defined maximum depth, but at least including
     the revision with the specified rev.
     """
-    revision = get_revision(apiurl, project, package)
-    if revision == None:
-	return None
+    with package_lock(apiurl, project, package):
+	revision = get_revision(apiurl, project, package)
+	if revision == None:
+	    return None
 
-    if opt_force:
-	commit_sha1 = None
-    else:
-	try:
-	    rev = revision['rev']
-	    revision_key = get_revision_key(apiurl, project, package, rev)
-	    commit_sha1 = bscache[revision_key]
-	except KeyError:
+	if opt_force:
 	    commit_sha1 = None
+	else:
+	    try:
+		revision_key = get_revision_key(apiurl, project, package,
+						revision.rev)
+		commit_sha1 = bscache[revision_key]
+	    except KeyError:
+		commit_sha1 = None
 
-    if not commit_sha1:
-	if need_rev:
-	    mark_as_needed_rec(need_rev, revision)
-	commit_sha1 = fetch_revision_rec(apiurl, project, package, revision,
-					 depth)
-	revision['commit_sha1'] = commit_sha1
+	if not commit_sha1:
+	    if need_rev:
+		mark_as_needed_rec(need_rev, revision)
+	    commit_sha1 = fetch_revision_rec(apiurl, project, package,
+					     revision, depth)
+	    revision.commit_sha1 = commit_sha1
 
-    remote_branch = remote_branch_name(apiurl, project, package)
-    sha1 = git_get_sha1(remote_branch)
-    if commit_sha1 != sha1:
-	update_branch(remote_branch, commit_sha1)
-    if check_uptodate:
-	check_link_uptodate(apiurl, project, package, depth)
-    return commit_sha1
+	remote_branch = remote_branch_name(apiurl, project, package)
+	sha1 = git_get_sha1(remote_branch)
+	if commit_sha1 != sha1:
+	    update_branch(remote_branch, commit_sha1)
+	bscache.commit()
+	if check_uptodate:
+	    check_link_uptodate(apiurl, project, package, depth)
+	return commit_sha1
+
+def package_lock(apiurl, project, package):
+    """Return the lock which serializes fetching a package when several
+    packages are fetched in parallel.  Link targets shared by several
+    packages are fetched only once this way.
+    """
+    key = remote_name(apiurl) + '/' + project + '/' + package
+    with package_lock.guard:
+	try:
+	    return package_lock.locks[key]
+	except KeyError:
+	    lock = threading.RLock()
+	    package_lock.locks[key] = lock
+	    return lock
+package_lock.locks = {}
+package_lock.guard = threading.Lock()
 
 def remote_name(url):
     return re.sub('^.*://', '', url)
@@ -828,6 +1186,8 @@ def update_branch(branch, commit_sha1):
     for the remote branches.
     """
 
+    # The commit may still be sitting in the fast-import stream.
+    importer.checkpoint()
     git_dir = git('rev-parse', '--git-dir')
     path = git_dir + '/' + branch
     try:
@@ -865,8 +1225,8 @@ def check_link_uptodate(apiurl, project, package, depth, silent=False):
     else:
 	revision = get_revision(apiurl, project, package)
 	baserev = guess_link_target(apiurl, project, package,
-				    revision['rev'], linkinfo,
-				    revision['time'], silent=True)
+				    revision.rev, linkinfo,
+				    revision.time, silent=True)
     if lsrcmd5 == baserev:
 	merge_sha1 = None
     else:
@@ -883,56 +1243,282 @@ def check_link_uptodate(apiurl, project, package, depth, silent=False):
     return check_link_uptodate.cached[key]
 check_link_uptodate.cached = {}
 
-def fetch_command(args):
-    """The fetch command."""
-    git('rev-parse', '--is-inside-work-tree')
-    if len(args) == 0:
-	branch = 'HEAD'
-    else:
-	branch = args[0]
+def plan_fetch(targets):
+    """Plan fetching the target packages: collect the revisions which will
+    be fetched as (apiurl, project, package, srcmd5) nodes, together with
+    the link target revisions each of them is based on, and the packages
+    which need to be fetched and which other packages they depend on.
+    Only metadata is queried; no files are downloaded and no commits are
+    created.  The metadata is kept in bscache like during a fetch (guessed
+    link targets, failed link expansions, and responses), so the fetch
+    does not need to query it again.
+
+    Returns a dict with:
+    {'nodes': {node: set of nodes it depends on},
+     'packages': {(apiurl, project, package): set of packages it depends on},
+     'downloads': set of MD5 hashes of files which are not cached yet,
+     'expanded': number of expanded link revisions,
+     'queries': number of metadata queries}
+
+    The targets are planned in parallel (see --jobs).  Targets whose
+    metadata cannot be queried are left for the fetch to report.
+    """
+    plan = {'nodes': {}, 'packages': {}, 'downloads': set(), 'expanded': 0,
+	    'queries': 0, 'lock': threading.RLock()}
+    def plan_target(target):
+	apiurl, project, package = target[0:3]
+	try:
+	    plan_package(apiurl, project, package, opt_depth, plan)
+	except EnvironmentError:
+	    pass
+    run_parallel(plan_target, targets, opt_jobs)
+    return plan
+
+def plan_count(plan, what):
+    with plan['lock']:
+	plan[what] += 1
+
+def plan_package(apiurl, project, package, depth, plan):
+    """Add what fetch_package() would fetch to PLAN."""
+    key = (apiurl, project, package)
+    dependencies = set()
+    with plan['lock']:
+	if key in plan['packages']:
+	    return
+	plan['packages'][key] = dependencies
+    plan_count(plan, 'queries')
+    revision = get_revision(apiurl, project, package)
+    if revision == None:
+	return
+
+    for revision, depth in revisions_to_fetch(revision, depth):
+	node = (apiurl, project, package, revision.srcmd5)
+	node_dependencies = set()
+	with plan['lock']:
+	    plan['nodes'][node] = node_dependencies
+	status = get_base_status(apiurl, project, package, revision.rev,
+				 silent=True)
+	plan_count(plan, 'queries')
+	plan_files(status, plan)
+	if 'linkinfo' in status and 'baserev' in status['linkinfo']:
+	    linkinfo = status['linkinfo']
+	    lproject = linkinfo['project']
+	    lpackage = linkinfo['package']
+	    node_dependencies.add(plan_base(apiurl, lproject, lpackage,
+					    linkinfo['baserev'], depth - 1, plan))
+	    dependencies.add((apiurl, lproject, lpackage))
+
+    # check_link_uptodate() fetches the latest expansion of the link target.
+    status = get_package_status(apiurl, project, package, rev='latest',
+				expand='1')
+    plan_count(plan, 'queries')
+    if 'linkinfo' in status:
+	linkinfo = status['linkinfo']
+	lkey = (apiurl, linkinfo['project'], linkinfo['package'])
+	if lkey != key:
+	    dependencies.add(lkey)
+	    plan_package(apiurl, lkey[1], lkey[2], sys.maxint, plan)
+
+def plan_base(apiurl, project, package, srcmd5, depth, plan):
+    """Add what fetch_base_rec() would fetch to PLAN, and return the node of
+    the base revision."""
+    node = (apiurl, project, package, srcmd5)
+    with plan['lock']:
+	if node in plan['nodes']:
+	    return node
+    revision = get_revision(apiurl, project, package, srcmd5)
+    if revision == None:
+	# An expanded revision of a link of a link.
+	node_dependencies = set()
+	with plan['lock']:
+	    if node in plan['nodes']:
+		return node
+	    plan['nodes'][node] = node_dependencies
+	plan_count(plan, 'expanded')
+	status = get_package_status(apiurl, project, package, rev=srcmd5)
+	plan_count(plan, 'queries')
+	plan_files(status, plan)
+	linkinfo = status['linkinfo']
+	node_dependencies.add(plan_base(apiurl, linkinfo['project'],
+					linkinfo['package'], linkinfo['srcmd5'],
+					depth - 1, plan))
+    plan_package(apiurl, project, package, sys.maxint, plan)
+    return node
+
+def plan_files(status, plan):
+    """Add the files of a revision which are not cached yet to PLAN."""
+    if bscache.has_key('tree ' + status['srcmd5']):
+	return
+    for file in status['files']:
+	if not bscache.has_key('blob ' + file['md5']):
+	    with plan['lock']:
+		plan['downloads'].add(file['md5'])
+
+def print_plan(plan):
+    link_targets = set()
+    for dependencies in plan['packages'].values():
+	link_targets.update(dependencies)
+    print "%d packages (%d link targets), %d revisions to fetch " \
+	  "(%d expanded link revisions)." % \
+	  (len(plan['packages']), len(link_targets), len(plan['nodes']),
+	   plan['expanded'])
+    print "Expecting %d metadata queries and %d file downloads." % \
+	  (plan['queries'], len(plan['downloads']))
+
+def fetch_target(arg):
+    """Figure out which package a fetch command argument refers to.
+
+    Returns apiurl, project, package, branch, remote_branch.
+    """
     try:
-	apiurl, project, package, branch, remote_branch = \
-	    get_rev_info(branch)
+	return get_rev_info(arg)
     except IOError, error:
 	if opt_apiurl:
 	    apiurl = opt_apiurl
 	else:
 	    apiurl = osc.conf.config['apiurl']
 	try:
-	    project, package = branch.split('/', 1)
+	    project, package = arg.split('/', 1)
 	except ValueError:
 	    raise error
 	if package.find('/') != -1:
 	    raise error
 	branch = package
 	remote_branch = remote_branch_name(apiurl, project, package)
+	return apiurl, project, package, branch, remote_branch
 
-    # Add any objects added to bscache in the meantime.
-    if git_get_sha1(branch):
-	bscache.update(branch)
+def fetch_packages(targets):
+    """Fetch packages.  With more than one target, what needs to be fetched
+    is planned first (see plan_fetch()); the packages are then fetched in
+    dependency order, so that link targets are fetched before the links
+    based on them, and each package is fetched only once.  Independent
+    packages are fetched in parallel.  (A single target is fetched right
+    away; fetch_package() fetches the link targets it needs itself.)
 
-    commit_sha1 = fetch_package(apiurl, project, package, opt_depth)
-    if commit_sha1 == None:
-	print "This package is empty."
-	print ("(Use \"%s push <project>/<package>\" for pushing from HEAD into an " + \
-	       "empty package.)") % basename(sys.argv[0])
+    When there is more than one target, how long fetching each of them
+    took is printed.  Returns the commit_sha1 of each target.
+    """
+    if len(targets) == 1:
+	plan = {'packages': {}}
+    else:
+	plan = plan_fetch(targets)
+    depths = {}
+    for key in plan['packages']:
+	depths[key] = sys.maxint
+    for target in targets:
+	depths[tuple(target[0:3])] = opt_depth
+
+    fetched = {}
+    def fetch(key):
+	apiurl, project, package = key
+	start = time.time()
+	try:
+	    commit_sha1 = fetch_package(apiurl, project, package, depths[key])
+	    error = None
+	except EnvironmentError, error:
+	    if len(targets) == 1 and key == tuple(targets[0][0:3]):
+		raise
+	    commit_sha1 = None
+	fetched[key] = commit_sha1, error, time.time() - start
+    for level in dependency_levels(sorted(depths.keys()), plan['packages']):
+	jobs = opt_jobs
+	members = set(level)
+	for key in level:
+	    if members.intersection(plan['packages'].get(key, ())) - set([key]):
+		# Packages which link to each other: fetching them in
+		# parallel would deadlock on their package locks.
+		print >>stderr, "Warning: some of the packages %s link to " \
+				"each other; fetching them one at a time." % \
+				', '.join([other[1] + '/' + other[2]
+					   for other in level])
+		jobs = 1
+		break
+	run_parallel(fetch, level, jobs)
+    results = [fetched[tuple(target[0:3])] for target in targets]
+    if len(targets) == 1:
+	return [results[0][0]]
+
+    print
+    for target, (commit_sha1, error, seconds) in zip(targets, results):
+	name = target[1] + '/' + target[2]
+	if error:
+	    print "%-50s %8.1fs  failed: %s" % (name, seconds, error)
+	elif commit_sha1 == None:
+	    print "%-50s %8.1fs  empty" % (name, seconds)
+	else:
+	    print "%-50s %8.1fs  %s" % (name, seconds,
+					 git_abbrev_rev(commit_sha1))
+    failed = len([result for result in results if result[1]])
+    if failed:
+	raise IOError("%d of %d packages could not be fetched." %
+		      (failed, len(targets)))
+    return [result[0] for result in results]
+
+def fetch_command(args):
+    """The fetch command."""
+    git('rev-parse', '--is-inside-work-tree')
+    if len(args) == 0:
+	args = ['HEAD']
+    targets = [fetch_target(arg) for arg in args]
+
+    # Add any objects added to the repository in the meantime.
+    bscache.update()
+
+    if opt_plan:
+	print_plan(plan_fetch(targets))
 	return
+    commit_sha1s = fetch_packages(targets)
+
+    for target, commit_sha1 in zip(targets, commit_sha1s):
+	apiurl, project, package, branch, remote_branch = target
+	if commit_sha1 == None:
+	    if len(targets) == 1:
+		print "This package is empty."
+		print ("(Use \"%s push <project>/<package>\" for pushing from HEAD into an " + \
+		       "empty package.)") % basename(sys.argv[0])
+	    continue
+
+	sha1 = git_get_sha1(branch)
+	if sha1 == None:
+	    remote = remote_name(apiurl)
+	    git('config', 'remote.%s.fetch' % remote, '+refs/heads/*:refs/remotes/%s/*' % remote)
+	    git('branch', '--track', branch, remote_branch)
+	    print "Branch '%s' created." % branch
+	elif sha1 == commit_sha1:
+	    print "Branch %s already up-to-date." % branch
+	else:
+	    print "Branch '%s' differs from the remote branch." % branch
+	try:
+	    git('rev-parse', '--verify', 'HEAD')
+	except IOError:
+	    git('checkout', '-f', branch)
+    return
 
-    sha1 = git_get_sha1(branch)
-    if sha1 == None:
-	remote = remote_name(apiurl)
-	git('config', 'remote.%s.fetch' % remote, '+refs/heads/*:refs/remotes/%s/*' % remote)
-	git('branch', '--track', branch, remote_branch)
-	print "Branch '%s' created." % branch
-    elif sha1 == commit_sha1:
-	print "Branch %s already up-to-date." % branch
+def get_project_packages(apiurl, project):
+    """Return the names of the packages in a project.
+
+    https://api.opensuse.org/source/PROJECT
+      <directory count="...">
+	<entry name="PACKAGE" />
+	...
+      </directory>
+    """
+    root = get_xml_root(apiurl, ['source', project])
+    return [node.get('name') for node in root.findall('entry')]
+
+def fetch_project_command(args):
+    """The fetch-project command."""
+    git('rev-parse', '--is-inside-work-tree')
+    if opt_apiurl:
+	apiurl = opt_apiurl
     else:
-	print "Branch '%s' differs from the remote branch." % branch
-    try:
-	git('rev-parse', '--verify', 'HEAD')
-    except IOError:
-	git('checkout', '-f', branch)
-    return
+	apiurl = osc.conf.config['apiurl']
+    project = args[0]
+    packages = get_project_packages(apiurl, project)
+    if len(packages) == 0:
+	print "Project %s has no packages." % project
+	return
+    fetch_command([project + '/' + package for package in packages])
 
 def pull_command(args):
     """The pull command."""
@@ -943,9 +1529,8 @@ def pull_command(args):
     apiurl, project, package, branch, remote_branch = \
 	get_rev_info(branch)
 
-    # Add any objects added to bscache in the meantime.
-    if git_get_sha1(branch):
-	bscache.update(branch)
+    # Add any objects added to the repository in the meantime.
+    bscache.update()
 
     commit_sha1 = fetch_package(apiurl, project, package, opt_depth)
     if commit_sha1 == None:
@@ -961,33 +1546,31 @@ def pull_command(args):
 	print "Branch '%s' updated." % branch
 
 def push_file(apiurl, project, package, name, blob_sha1):
-    cmd = [opt_git, 'cat-file', 'blob', blob_sha1]
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    # FIXME: should do this in batches and not in one go ...
-    data = proc.stdout.read()
-    md5 = hashlib.md5(data).hexdigest()
-
+    """Upload a file, and return its MD5 hash.  The file is streamed from
+    git to the server, and hashed on the way."""
+    size = catfile.info(blob_sha1)[2]
     query = {'rev': 'repository'}
     url = osc.core.makeurl(apiurl, ['source', project, package, name], query)
     if opt_verbose:
 	print "-- PUT " + url
-    osc.core.http_PUT(url, data=data)
-    return md5
-
-def push_commit(apiurl, project, package, message, sha1, old_status, committer,
-		baserev=None):
-    """Push a commit.
-
-    The old status is used to identify files which the server definitely knows about
-    already, and which we don't need to upload."""
-    old_files = {}
-    for file in old_status['files']:
-	name = file['name']
-	md5 = file['md5']
-	old_files[name] = md5
-
-    new_files = git_list_tree(sha1)
-    for file in new_files:
+    blob = BlobFile(opt_git, blob_sha1)
+    try:
+	transport.put(url, blob, {'Content-Length': str(size)}).read()
+    finally:
+	blob.close()
+    if blob.size != size:
+	raise IOError("Blob %s: expected %d bytes, got %d" %
+		      (blob_sha1, size, blob.size))
+    return blob.hexdigest()
+
+def list_push_files(sha1):
+    """Return the files of a commit to push, with their SHA1 and MD5 hashes.
+    The MD5 hashes come from the manifest of the tree (see
+    BuildServiceCache.manifest()), so blobs are only read when the tree is
+    new."""
+    files = git_list_tree(sha1)
+    md5s = dict(bscache.manifest(catfile.info(sha1 + '^{tree}')[0]))
+    for file in files:
 	name = file['name']
 	mode = file['mode']
 	if mode[0:3] != '100':
@@ -997,22 +1580,45 @@ def push_commit(apiurl, project, package, message, sha1, old_status, committer,
 	    print >>stderr, "Warning: commit %s, '%s': cannot preserve file " \
 			    "mode %s; falling back to 644." % \
 			    (git_abbrev_rev(sha1), name, mode[3:])
+	file['md5'] = md5s[name]
+    return files
+
+def upload_files(apiurl, project, package, sha1, files):
+    """Upload the files of a commit in parallel (see --jobs).  All files are
+    tried; the files which could not be uploaded are reported one by one,
+    and then an exception is raised."""
+    def upload(file):
 	try:
-	    md5 = old_files[name]
-	    sha1 = bscache['blob ' + md5]
-	    if sha1 == file['sha1']:
-	        file['md5'] = md5
-		continue
-        except KeyError:
-	    pass
-	md5 = push_file(apiurl, project, package, name, file['sha1'])
-	file['md5'] = md5
+	    md5 = push_file(apiurl, project, package, file['name'],
+			    file['sha1'])
+	    if md5 != file['md5']:
+		raise IOError('MD5 checksum mismatch')
+	except EnvironmentError, error:
+	    return error
+	return None
 
+    errors = run_parallel(upload, files, opt_jobs)
+    failed = [(file, error) for file, error in zip(files, errors)
+	      if error != None]
+    if failed:
+	for file, error in failed:
+	    print >>stderr, "Commit %s, '%s': %s" % \
+			    (git_abbrev_rev(sha1), file['name'], error)
+	raise IOError("Commit %s: %d of %d files could not be uploaded" %
+		      (git_abbrev_rev(sha1), len(failed), len(files)))
+
+def push_commit(apiurl, project, package, message, sha1, files, committer,
+		baserev=None):
+    """Push a commit with the given files (see list_push_files()).
+
+    The list of files is sent first.  The server knows most files already,
+    so it only reports the files it is missing (error="missing"); those are
+    uploaded, and the list is sent again.  Renamed files and files from
+    other revisions are not uploaded at all this way."""
     directory = ET.Element('directory')
-    for file in new_files:
-	name=file['name']
-	md5=file['md5']
-	directory.append(ET.Element('entry', name=name, md5=md5))
+    for file in files:
+	directory.append(ET.Element('entry', name=file['name'],
+				    md5=file['md5']))
 
     query = {'cmd': 'commitfilelist',
 	     'rev': 'repository',
@@ -1025,11 +1631,24 @@ def push_commit(apiurl, project, package, message, sha1, old_status, committer,
 	query['keeplink'] = '1'
 
     url = osc.core.makeurl(apiurl, ['source', project, package], query=query)
-    if opt_verbose:
-	print "-- POST " + url
-    file = osc.core.http_POST(url, data=ET.tostring(directory))
-    root = ET.parse(file).getroot()
-    new_status = parse_xml_directory(root)
+    for attempt in range(2):
+	if opt_verbose:
+	    print "-- POST " + url
+	file = transport.post(url, ET.tostring(directory))
+	new_status = parse_xml_directory(file)
+	if new_status.get('error') != 'missing':
+	    break
+	if attempt != 0:
+	    raise IOError("Commit %s: the server is still missing %d files" %
+			  (git_abbrev_rev(sha1), len(new_status['files'])))
+	by_name = dict([(file['name'], file) for file in files])
+	missing = []
+	for entry in new_status['files']:
+	    if entry['name'] not in by_name:
+		raise IOError("Commit %s: the server is missing unknown file "
+			      "'%s'" % (git_abbrev_rev(sha1), entry['name']))
+	    missing.append(by_name[entry['name']])
+	upload_files(apiurl, project, package, sha1, missing)
     return new_status
 
 def push_command(args):
@@ -1067,14 +1686,9 @@ def push_command(args):
 
     base_status = get_base_status(apiurl, project, package)
 
-    if remote_sha1 != None:
-	try:
-	    merge_base = git('merge-base', remote_branch, sha1)
-	except IOError:
-	    merge_base = None
-	if merge_base != remote_sha1:
-	    raise IOError("Branch '%s' is not a child of the remote branch. "
-			  "Please rebase first." % branch)
+    if remote_sha1 != None and not bscache.is_ancestor(remote_sha1, sha1):
+	raise IOError("Branch '%s' is not a child of the remote branch. "
+		      "Please rebase first." % branch)
 
     # Require a clean index: otherwise, we would lose local chages when doing
     # a hard reset below.merge-base'
@@ -1083,13 +1697,15 @@ def push_command(args):
     # Login name of the user who will show up as the creator of a commit.
     committer = osc.conf.get_apiurl_usr(apiurl)
 
+    # Read all the commits to push at once.
+    commits = git_get_commits(sha1, remote_sha1)
     path = []
     while sha1 != remote_sha1:
-	info = git_get_commit(sha1)
 	try:
-	    parents = info['parents']
+	    parents, email, message = commits[sha1]
 	except KeyError:
-	    parents = []
+	    raise IOError("Commit %s does not lead to the remote branch." %
+			  git_abbrev_rev(sha1))
 	baserev = None
 	if len(parents) == 0:
 	    parent = None
@@ -1112,22 +1728,27 @@ def push_command(args):
 	    raise IOError("Commit %s is an n-way merge, cannot push."
 			  % git_abbrev_rev(sha1))
 
-	email = info['author']['email']
-	login = map_email_to_login(apiurl, email)
-	if login != committer:
-	    print >>stderr, "Warning: commit %s from %s will appear to be " \
-			    "from %s.\n" % (git_abbrev_rev(sha1), login,
-					    committer)
-	message = info['message']
-
-	path.append([sha1, message, baserev])
+	path.append([sha1, message, baserev, email])
 	if parent == None:
 	    break
 	sha1 = parent
 
+    logins = map_emails_to_logins(apiurl, [node[3] for node in path])
+    for node in path:
+	login = logins[node.pop()]
+	if login != committer:
+	    print >>stderr, "Warning: commit %s from %s will appear to be " \
+			    "from %s.\n" % (git_abbrev_rev(node[0]), login,
+					    committer)
+
     # Put path into "chronological" order
     path.reverse()
 
+    # Check the files of all commits, and compute their MD5 hashes, before
+    # pushing anything.
+    for node in path:
+	node.append(list_push_files(node[0]))
+
     if 'linkinfo' in base_status:
 	linkinfo = base_status['linkinfo']
 	if 'baserev' in linkinfo:
@@ -1150,14 +1771,14 @@ def push_command(args):
     print "Pushing %d %s" % (len(path), commit_s)
     revision = get_revision(apiurl, project, package)
     if revision != None:
-	next_rev = str(int(revision['rev']) + 1)
+	next_rev = str(int(revision.rev) + 1)
     else:
 	next_rev = '1'
 
     for node in path:
-	sha1, message, baserev = node
+	sha1, message, baserev, files = node
 	base_status = push_commit(apiurl, project, package, message, sha1,
-				  base_status, committer, baserev)
+				  files, committer, baserev)
 	if base_status['rev'] != next_rev:
 	    raise IOError("Expected to create revision %s, but ended up with "
 			  "revision %s" % (next_rev, base_status['rev']))
@@ -1174,42 +1795,50 @@ def push_command(args):
     print "Branch '%s' rebased from %s to %s." \
 	    % (branch, git_abbrev_rev(path[0][0]), git_abbrev_rev(remote_sha1))
 
+def format_usermap(login, email, realname, aliases):
+    """Format a usermap line: login, email (or '?'), and any other email
+    addresses that map to login."""
+    aliases = [alias for alias in aliases if alias != email]
+    if email == None:
+	email = '?'
+    if realname:
+	email = '"' + realname + ' <' + email + '>"'
+    return login + ' ' + email + ' ' + ' '.join(aliases)
+
 def usermap_command(args):
     """The usermap command."""
     if len(args) == 0:
-	logins = []
-	for key in bscache.keys():
-	    if key[0:6] == 'email ':
-		logins.append(key[6:])
-	for login in sorted(logins):
-	    usermap_command([login])
+	# One pass over each kind of key, all in login order.
+	realnames = {}
+	for key, realname in bscache.iter_prefix('realname '):
+	    realnames[key[9:]] = realname
+	aliases = {}
+	for key, login in bscache.iter_prefix('login '):
+	    if login not in aliases:
+		aliases[login] = []
+	    aliases[login].append(key[6:])
+	for key, email in bscache.iter_prefix('email '):
+	    login = key[6:]
+	    print format_usermap(login, email, realnames.get(login),
+				 aliases.get(login, []))
 	return
 
     login = args[0]
     login_utf8 = login.encode('UTF-8')
     if len(args) == 1:
+	realname = None
 	try:
-	    email = bscache['email ' + login_utf8].decode('UTF-8')
+	    email = bscache['email ' + login_utf8]
 	    try:
-		realname = bscache['realname ' + login_utf8].decode('UTF-8')
+		realname = bscache['realname ' + login_utf8]
 	    except KeyError:
-		realname = None
 		pass
 	except KeyError:
 	    email = None
-	aliases = []
-	for key in bscache.keys():
-	    if key[0:6] == 'login ' and key[6:] != email and \
-	       bscache[key] == login_utf8:
-		aliases.append(key[6:])
-	if email == None:
-	    if len(aliases) == 0:
-		return
-	    else:
-		email='?'
-	if realname:
-		email = '"' + realname + ' <' + email + '>"'
-	print login + ' ' + email + ' ' + ' '.join(aliases)
+	aliases = bscache.aliases(login_utf8)
+	if email == None and len(aliases) == 0:
+	    return
+	print format_usermap(login_utf8, email, realname, aliases)
     else:
 	first_email = True
 	for email in args[1:]:
@@ -1240,8 +1869,33 @@ def usermap_command(args):
 
 def dump_command(args):
     """The dump command."""
-    for key in bscache.keys():
-	print "%s %s" % (key, bscache[key])
+    for key, value in bscache.iter_prefix(''):
+	if key.startswith('manifest '):
+	    # Binary; see bscache.pack_manifest().
+	    value = ' '.join(['%s:%s' % (md5, name)
+			      for name, md5 in unpack_manifest(value)])
+	elif key.startswith('history ') or key.startswith('response '):
+	    # Multi-line; see format_history_value() and get_xml().
+	    value = value.encode('string_escape')
+	print "%s %s" % (key, value)
+
+def migrate_cache_command(args):
+    """The migrate-cache command."""
+    if len(args) == 0:
+	name = git('rev-parse', '--git-dir') + '/bscache'
+    else:
+	name = args[0]
+    old = open_storage(name, 'bsddb')
+    count = 0
+    for table in TABLES:
+	for key, value in old.items(table):
+	    if table != 'other':
+		key = table + ' ' + key
+	    bscache[key] = value
+	    count += 1
+    old.close()
+    bscache.commit()
+    print "Imported %d entries from %s." % (count, name)
 
 def usage(status):
     print """Usage: %s [options] <command> [args]
@@ -1249,15 +1903,20 @@ def usage(status):
 Import build service packages into git.
 
 Commands are:
-    fetch, fetch <branch>, fetch <project>/<package>
+    fetch, fetch <branch>, fetch <project>/<package> ...
 	Update the remote branch tracking the specified <project> and
 	<package>.  If no project and package is specified, the default
 	is to fetch the remote branch that the current branch tracks
-	(refs/remotes/<server>/<project>/<package>).
+	(refs/remotes/<server>/<project>/<package>).  When more than one
+	package is specified, the packages are fetched in parallel.  Link
+	targets are fetched before the links based on them.
 
 	When a branch point is hit (i.e., a revision that creates a new link
 	or updates an existing link), the target package is fetched as well.
 
+    fetch-project <project>
+	Fetch all packages in <project> in parallel, as with fetch.
+
     pull, pull <branch>
 	Do a fetch of the remote branch that the current branch is tracking,
 	followed by a rebase of the current branch.
@@ -1280,6 +1939,10 @@ Commands are:
     dump
 	Dump the build service cache (for debugging).
 
+    migrate-cache [<file>]
+	Import the cache of a previous version of bsgit (.git/bscache, in
+	Berkeley DB format) into the current cache (.git/bscache.db).
+
 Options are:
     --apiurl=<apiurl>, -A <apiurl>
 	Use the specified protocol/server instead of the default from .oscrc.
@@ -1289,15 +1952,55 @@ Options are:
 	number of revisions.  (Note that the --force option is required for
 	later increasing the depth.)
 
+    -j <jobs>, --jobs=<jobs>
+	Fetch up to the specified number of packages, and download (or, with
+	push, upload) up to the specified number of files per package at the
+	same time (default: 4).
+
+    --max-connections=<connections>
+	Use up to the specified number of connections to each build service
+	server at the same time (default: 8).  Connections are kept open
+	and reused for further requests.  (Requests go through the proxies
+	in the http_proxy and https_proxy environment variables unless
+	no_proxy says otherwise, and certificates are checked according to
+	the sslcertck, cafile and capath options in .oscrc.  Only HTTP Basic
+	authentication is supported.)
+
+    --plan
+	With fetch and fetch-project, only plan the fetch: show how many
+	packages and revisions would be fetched, and how many queries and
+	file downloads this is expected to take.  No files are downloaded,
+	but the metadata queried is kept in .git/bscache.db for the fetch.
+
+    --prefetch=<revisions>
+	Download the files of up to the specified number of revisions ahead
+	of time while creating the commits of earlier revisions (default: 4;
+	0 disables this).
+
+    --recheck
+	Ask the build service again for link expansions which failed before.
+	(Failed expansions are otherwise remembered for thirty days.)
+
+    --shared-cache=<directory>
+	Keep downloaded files in the specified directory, and take files from
+	there instead of downloading them again.  The directory can be shared
+	by all repositories (and bsgit processes) on a machine.
+
+    --shared-cache-size=<megabytes>
+	Limit the size of the shared cache (default: 4096).  The files used
+	least recently are removed first.
+
     -f, --force
 	Recreate all commits even if they appear to be present already.  Files
-	still remain cached.  (Remove .git/bscache to recompute the MD5 checksums.)
+	still remain cached.  (Remove .git/bscache.db to recompute the MD5
+	checksums.)
 
     -t, --traceback
 	Print a call trace in case of an error (for debugging).
 
     --verbose
-	Be verbose about which requests are being made to the build service.
+	Be verbose about which requests are being made to the build service,
+	and print how long they took in total.
 	""" \
 	% basename(sys.argv[0])
     sys.exit(status)
@@ -1308,9 +2011,12 @@ def main():
     need_osc_config = False
 
     try:
-	opts, args = getopt.gnu_getopt(sys.argv[1:], 'A:tfvh', \
+	opts, args = getopt.gnu_getopt(sys.argv[1:], 'A:j:tfvh', \
 				       ['help', 'depth=', 'git=', 'force',
-				        'apiurl=', 'traceback', 'verbose'])
+				        'apiurl=', 'jobs=', 'max-connections=',
+				        'plan', 'prefetch=', 'recheck',
+				        'shared-cache=', 'shared-cache-size=',
+				        'traceback', 'verbose'])
     except getopt.GetoptError, err:
 	print err
 	usage(2)
@@ -1329,6 +2035,27 @@ def main():
 	elif opt in ('-A', '--apiurl'):
 	    global opt_apiurl
 	    opt_apiurl = arg
+	elif opt in ('-j', '--jobs'):
+	    global opt_jobs
+	    opt_jobs = int(arg)
+	elif opt == '--max-connections':
+	    global opt_max_connections
+	    opt_max_connections = int(arg)
+	elif opt == '--prefetch':
+	    global opt_prefetch
+	    opt_prefetch = int(arg)
+	elif opt == '--recheck':
+	    global opt_recheck
+	    opt_recheck = True
+	elif opt == '--shared-cache':
+	    global opt_shared_cache
+	    opt_shared_cache = arg
+	elif opt == '--shared-cache-size':
+	    global opt_shared_cache_size
+	    opt_shared_cache_size = int(arg)
+	elif opt == '--plan':
+	    global opt_plan
+	    opt_plan = True
 	elif opt in ('-t', '--traceback'):
 	    opt_traceback = True
         elif opt in ('-v', '--verbose'):
@@ -1340,10 +2067,14 @@ def main():
 
     command = None
     if len(args) >= 1:
-	if args[0] == 'fetch' and len(args) >= 1 and len(args) <= 2:
+	if args[0] == 'fetch':
 	    need_osc_config = True
 	    need_bscache = True
 	    command = fetch_command
+	elif args[0] == 'fetch-project' and len(args) == 2:
+	    need_osc_config = True
+	    need_bscache = True
+	    command = fetch_project_command
 	elif args[0] == 'pull' and len(args) >= 1 and len(args) <= 2:
 	    need_osc_config = True
 	    need_bscache = True
@@ -1358,6 +2089,9 @@ def main():
 	elif args[0] == 'usermap':
 	    need_bscache = True
 	    command = usermap_command
+	elif args[0] == 'migrate-cache' and len(args) <= 2:
+	    need_bscache = True
+	    command = migrate_cache_command
     if command == None:
 	usage(2)
 
@@ -1365,11 +2099,27 @@ def main():
 	try:
 	    if need_osc_config:
 		osc.conf.get_config()
+		global transport
+		transport = HTTPTransport(opt_max_connections, get_credentials,
+					  get_ssl_context)
+		if opt_shared_cache:
+		    global shared_cache
+		    shared_cache = SharedCache(opt_shared_cache,
+					       opt_shared_cache_size << 20)
 
 	    if need_bscache:
-		global bscache
+		global bscache, catfile, importer
 		git_dir = git('rev-parse', '--git-dir')
-		bscache = BuildServiceCache(git_dir + '/bscache', opt_git)
+		catfile = GitCatFile(opt_git)
+		importer = GitFastImport(opt_git)
+		catfile.missing_hook = importer.checkpoint
+		if command != migrate_cache_command and \
+		   exists(git_dir + '/bscache') and \
+		   not exists(git_dir + '/bscache.db'):
+		    print >>stderr, "Note: use the migrate-cache command to " \
+				    "import the cache of a previous version."
+		bscache = BuildServiceCache(git_dir + '/bscache.db', opt_git,
+					    catfile)
 
 	    command(args[1:])
 	except (KeyboardInterrupt, EnvironmentError), error:
@@ -1379,6 +2129,22 @@ def main():
 	    else:
 		print >>stderr, error
 	    raise
+	finally:
+	    # Objects already recorded in bscache must make it into the
+	    # repository even if we are bailing out.
+	    if importer:
+		importer.close()
+	    if transport:
+		transport.close()
+		if opt_verbose:
+		    print transport.summary()
+		    if get_expanded_status.saved:
+			print "%d requests for failed link expansions saved" % \
+			      get_expanded_status.saved
+	    if shared_cache:
+		shared_cache.close()
+	    if bscache:
+		bscache.close()
     except HTTPError, error:
 	if hasattr(error, 'osc_msg'):
 	    print >>stderr, error.osc_msg
@@ -1 +1,2 @@
-__all__ = ['bscache']
+__all__ = ['bscache', 'catfile', 'fastimport', 'history', 'sharedcache',
+	   'storage', 'transport', 'workers']
@@ -22,19 +22,40 @@
 import sys
 import subprocess
 import hashlib
-import bsddb
 import getopt
-import re
+import threading
+from binascii import hexlify, unhexlify
+from bsgit.catfile import GitCatFile, parse_tree
+from bsgit.storage import open_storage, TABLES
 
 #-----------------------------------------------------------------------
 
 def compute_srcmd5(files):
     """Return the srcmd5 checksum of a ist of files."""
+    return manifest_srcmd5(sorted([(file['name'], file['md5'])
+				   for file in files]))
+
+def manifest_srcmd5(entries):
+    """Return the srcmd5 checksum of (name, md5) pairs sorted by name."""
     hasher = hashlib.md5()
-    for file in sorted(files, cmp=lambda a,b: cmp(a['name'], b['name'])):
-	hasher.update('%s  %s\n' % (file['md5'], file['name']))
+    for name, md5 in entries:
+	hasher.update(md5 + '  ' + name + '\n')
     return hasher.hexdigest()
 
+def pack_manifest(entries):
+    """Pack (name, md5) pairs sorted by name into a manifest: the binary
+    MD5 digest of each file followed by its name and a null byte."""
+    return ''.join([unhexlify(md5) + name + '\0' for name, md5 in entries])
+
+def unpack_manifest(data):
+    entries = []
+    pos = 0
+    while pos < len(data):
+	nul = data.index('\0', pos + 16)
+	entries.append((data[pos + 16:nul], hexlify(data[pos:pos + 16])))
+	pos = nul + 1
+    return entries
+
 def check_proc(proc, cmd):
     """Check the status of a subprocess and raise an exception on failure."""
     status = proc.wait()
@@ -45,123 +66,304 @@ class BuildServiceCache:
     """On-disk cache for mapping between the MD5 hashes of various build
     service objects (files, directory listings, commits) and the corresponding
     git SHA1 hashes.
+
+    Keys are of the form '<kind> <key>' (for example, 'blob <md5>'); each
+    kind of key is kept in its own table of the storage engine.
     """
-    def __init__(self, name, opt_git):
+    def __init__(self, name, opt_git, catfile=None, engine='sqlite'):
 	self.database_name = name
 	self.opt_git = opt_git
-	self.hash = bsddb.hashopen(name)
+	if catfile == None:
+	    catfile = GitCatFile(opt_git)
+	self.catfile = catfile
+	self.storage = open_storage(name, engine)
+	# The cache is shared between the threads fetching packages.
+	self.lock = threading.RLock()
+
+    def split_key(self, key):
+	try:
+	    table, rest = key.split(' ', 1)
+	    if table in TABLES and table != 'other':
+		return table, rest
+	except ValueError:
+	    pass
+	return 'other', key
 
     def has_key(self, key):
-	return self.hash.has_key(key)
+	try:
+	    self[key]
+	    return True
+	except KeyError:
+	    return False
 
     def keys(self):
-	return self.hash.keys()
+	return [key for key, value in self.iter_prefix('')]
+
+    def iter_prefix(self, prefix):
+	"""Iterate over the key, value pairs whose keys start with prefix (for
+	example, 'login '), grouped by kind and in key order.  Only the tables
+	which can contain such keys are looked at, using their key index.
+	(Not to be used while other threads modify the cache.)"""
+	table, rest = self.split_key(prefix)
+	if table != 'other':
+	    tables = [(table, rest)]
+	else:
+	    # The prefix does not contain a complete kind.
+	    tables = [(table, '') for table in TABLES
+		      if table != 'other' and table.startswith(prefix)]
+	    tables.append(('other', prefix))
+	for table, rest in tables:
+	    for key, value in self.storage.items(table, rest):
+		if table != 'other':
+		    key = table + ' ' + key
+		yield key, value
+
+    def get_many(self, keys):
+	"""Look up several keys at once.  Returns a dict with the values of
+	those keys which exist."""
+	tables = {}
+	for key in keys:
+	    table, rest = self.split_key(key)
+	    tables.setdefault(table, []).append(rest)
+	values = {}
+	with self.lock:
+	    for table, rests in tables.items():
+		for rest, value in self.storage.get_many(table, rests).items():
+		    if table != 'other':
+			rest = table + ' ' + rest
+		    values[rest] = value
+	return values
+
+    def aliases(self, login):
+	"""Return all email addresses mapping to login, in order.  This is
+	the reverse of the 'login <email>' keys; the storage engine keeps an
+	index for it."""
+	with self.lock:
+	    return self.storage.find('login', login)
+
+    def blob_md5(self, blob_sha1):
+	"""Return the MD5 hash of a known blob.  This is the reverse of the
+	'blob <md5>' keys; the storage engine keeps an index for it."""
+	with self.lock:
+	    md5s = self.storage.find('blob', blob_sha1)
+	if len(md5s) == 0:
+	    raise KeyError(blob_sha1)
+	return md5s[0]
 
     def __getitem__(self, key):
-	return self.hash[key]
+	table, key = self.split_key(key)
+	with self.lock:
+	    return self.storage.get(table, key)
 
     def __setitem__(self, key, value):
-	self.hash[key] = value
+	table, key = self.split_key(key)
+	with self.lock:
+	    self.storage.put(table, key, value)
 
     def __delitem__(self, key):
-	del self.hash[key]
+	table, key = self.split_key(key)
+	with self.lock:
+	    self.storage.delete(table, key)
+
+    def commit(self):
+	"""Make all changes so far permanent."""
+	with self.lock:
+	    self.storage.commit()
+
+    def close(self):
+	with self.lock:
+	    self.storage.close()
 
     def add_blob(self, blob_sha1):
 	"""Add an existing git blob (file) to the cache."""
 	md5 = self.add_new_blob(blob_sha1)
-	self.hash['blob ' + md5] = blob_sha1
+	self['blob ' + md5] = blob_sha1
+	return md5
 
     def add_new_blob(self, blob_sha1):
 	hasher = hashlib.md5()
-	cmd = [self.opt_git, 'cat-file', 'blob', blob_sha1]
-	proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-	while True:
-	    data = proc.stdout.read(16384)
-	    if len(data) == 0:
-		break
+	for data in self.catfile.stream(blob_sha1, 'blob'):
 	    hasher.update(data)
-	proc.stdout.close()
-	check_proc(proc, cmd)
 	md5 = hasher.hexdigest()
 	return md5
 
-    def add_tree(self, tree_sha1, commit_sha1):
-	"""Add an existing git tree (directory) to the cache."""
-	md5 = self.add_new_tree(tree_sha1, commit_sha1)
-	self.hash['tree ' + md5] = tree_sha1
+    def add_tree(self, tree_sha1):
+	"""Add an existing git tree (directory) to the cache.  Only blobs not
+	in the cache yet are read and hashed."""
+	md5 = self.add_new_tree(tree_sha1)
+	if md5 != None:
+	    self['tree ' + md5] = tree_sha1
+	return md5
 
-    def add_new_tree(self, tree_sha1, commit_sha1):
-	# FIXME: newlines in filenames would need NUL-terminated format (-z)
-	# here.
-	cmd = [self.opt_git, 'ls-tree', tree_sha1]
-	proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-	files = []
-	for line in proc.stdout:
-	    mode, type, sha1, name = \
-		re.match('^(\d{6}) ([^ ]+) ([0-9a-f]{40})\t(.*)', line).groups()
-	    if type == 'blob':
-		md5 = self.add_blob(sha1)
-		files.append({'name': name, 'md5': md5})
-	    elif type == 'tree':
-		raise IOError('Commit %s: subdirectories not supported' %
-			      commit_sha1)
-	    else:
-	    	raise IOError('Commit %s: unexpected %s object' %
-			      (commit_sha1, type))
-	check_proc(proc, cmd)
+    def add_new_tree(self, tree_sha1):
+	entries = self.manifest(tree_sha1)
+	if entries == None:
+	    return None
+	return manifest_srcmd5(entries)
 
-	return compute_srcmd5(files)
+    def manifest(self, tree_sha1):
+	"""Return the (name, md5) pairs of the files in a tree, sorted by name,
+	or None if the tree cannot come from the build service.  The
+	manifests of trees are kept in the cache ('manifest <sha1>' keys), so
+	that the blobs of a tree need not be looked up or read again."""
+	try:
+	    return unpack_manifest(self['manifest ' + tree_sha1])
+	except KeyError:
+	    pass
+	entries = []
+	for mode, type, sha1, name in \
+		parse_tree(self.catfile.read(tree_sha1, 'tree')):
+	    if type != 'blob':
+		# Subdirectories etc. cannot come from the build service.
+		return None
+	    try:
+		md5 = self.blob_md5(sha1)
+	    except KeyError:
+		md5 = self.add_blob(sha1)
+	    entries.append((name, md5))
+	entries.sort()
+	self['manifest ' + tree_sha1] = pack_manifest(entries)
+	return entries
 
-    def add_commit(self, commit_sha1):
-	"""Add an existing git commit and all objects reachable from there
-	   to the cache.
+    def add_manifest(self, tree_sha1, entries):
+	"""Remember the (name, md5) pairs of the files in a tree."""
+	self['manifest ' + tree_sha1] = pack_manifest(sorted(entries))
 
-	   Note that the key for lookup here is the commit's SHA1 checksum.
-	   We use this to detech which commits (including all their children)
-	   are already in the cache.
+    def commit_graph(self, commit_sha1):
+	"""Return the generation number and the parents of a commit from the
+	commit graph index ('graph <sha1>' keys).  Commits not in the index
+	yet are added together with their missing ancestors.
 	"""
-	if not self.hash.has_key('commit ' + commit_sha1):
-	    print 'Caching commit ' + commit_sha1
-	    tree_sha1 = self.add_new_commit(commit_sha1)
-	    if tree_sha1 != None:
-		self.hash['commit ' + commit_sha1] = tree_sha1
+	try:
+	    return self.parse_graph(self['graph ' + commit_sha1])
+	except KeyError:
+	    pass
+	stack = [commit_sha1]
+	parents = {}
+	while stack:
+	    sha1 = stack[-1]
+	    if self.has_key('graph ' + sha1):
+		stack.pop()
+		continue
+	    if sha1 not in parents:
+		parents[sha1] = self.read_parents(sha1)
+	    missing = [parent for parent in parents[sha1]
+		       if not self.has_key('graph ' + parent)]
+	    if missing:
+		stack.extend(missing)
+		continue
+	    stack.pop()
+	    self.add_to_graph(sha1, parents[sha1])
+	return self.parse_graph(self['graph ' + commit_sha1])
 
-    def add_new_commit(self, commit_sha1):
-	cmd = [self.opt_git, 'cat-file', 'commit', commit_sha1]
-	proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-	tree_sha1 = None
-	for line in proc.stdout:
-	    try:
-	    	tag, sha1 = line.rstrip('\n').split(' ', 1)
-	    except ValueError: pass
-	    if tag == 'tree':
-		self.add_tree(sha1, commit_sha1)
-		if tree_sha1 != None:
-		    raise IOError('bad commit ' + sha1)
-		tree_sha1 = sha1
-	    elif tag == 'parent':
-		self.add_commit(sha1)
-	    elif tag == '':
-		proc.stdout.close()
+    def parse_graph(self, value):
+	fields = value.split(' ')
+	return int(fields[0]), fields[1:]
+
+    def read_parents(self, commit_sha1):
+	parents = []
+	for line in self.catfile.read(commit_sha1, 'commit').split('\n'):
+	    if line == '':
 		break
-	check_proc(proc, cmd)
-	return tree_sha1
+	    if line.startswith('parent '):
+		parents.append(line[7:])
+	return parents
+
+    def add_to_graph(self, commit_sha1, parents):
+	"""Add a commit with the given parents to the commit graph index.  Its
+	generation number is one more than the highest generation number of
+	its parents."""
+	generation = 0
+	for parent in parents:
+	    generation = max(generation, self.commit_graph(parent)[0])
+	self['graph ' + commit_sha1] = \
+	    ' '.join([str(generation + 1)] + list(parents))
+
+    def is_ancestor(self, ancestor_sha1, commit_sha1):
+	"""Check if ancestor_sha1 is a proper ancestor of commit_sha1.  The
+	walk back from commit_sha1 does not follow commits whose generation
+	number is too low for ancestor_sha1 to be one of their ancestors."""
+	generation = self.commit_graph(ancestor_sha1)[0]
+	stack = list(self.commit_graph(commit_sha1)[1])
+	seen = set()
+	while stack:
+	    sha1 = stack.pop()
+	    if sha1 == ancestor_sha1:
+		return True
+	    if sha1 in seen:
+		continue
+	    seen.add(sha1)
+	    sha1_generation, parents = self.commit_graph(sha1)
+	    if sha1_generation > generation:
+		stack.extend(parents)
+	return False
 
-    def update(self, obj):
-	"""Update the cache by adding all new objects reachable from obj."""
-	# FIXME: instead of following a specific object reference,
-	# hash the entire repository.
-	cmd = [self.opt_git, 'rev-parse', obj]
+    def ref_tips(self):
+	"""Return the commits that HEAD and the refs in the repository point
+	to (following tags)."""
+	cmd = [self.opt_git, 'for-each-ref',
+	       '--format=%(objectname) %(objecttype) %(*objecttype)']
 	proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-	sha1 = proc.stdout.read().rstrip('\n')
+	tips = set()
+	for line in proc.stdout:
+	    fields = line.split()
+	    if 'commit' in fields[1:]:
+		tips.add(fields[0])
 	check_proc(proc, cmd)
+	info = self.catfile.info('HEAD')
+	if info != None and info[1] == 'commit':
+	    tips.add(info[0])
+	return sorted(tips)
 
-	cmd = [self.opt_git, 'cat-file', '-t', sha1]
-	proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-	type = proc.stdout.read().rstrip('\n')
+    def new_commits(self, tips, old_tips):
+	"""Return the commits reachable from tips but not from old_tips, with
+	their trees and parents, parents first."""
+	cmd = [self.opt_git, 'rev-list', '--reverse', '--topo-order',
+	       '--format=%T %P', '--ignore-missing', '--stdin']
+	proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+				stdout=subprocess.PIPE)
+	input = tips + ['^' + sha1 for sha1 in old_tips]
+	output = proc.communicate('\n'.join(input) + '\n')[0]
 	check_proc(proc, cmd)
+	commits = []
+	for line in output.split('\n'):
+	    if line.startswith('commit '):
+		commit_sha1 = line[7:]
+	    elif line != '':
+		fields = line.split()
+		commits.append((commit_sha1, fields[0], fields[1:]))
+	return commits
 
-	if type == 'commit':
-	    self.add_commit(sha1)
-        else:
-	    raise IOError('%s is not a commit object' % obj)
+    def update(self):
+	"""Update the cache by adding all commits in the repository which are
+	not cached yet, including their trees and blobs.
+
+	The commits are also added to the commit graph index.  They are
+	processed parents first, and progress is committed regularly, so an
+	interrupted update resumes where it stopped.  The ref tips of the last
+	complete update are remembered; only commits not reachable from them
+	are looked at.
+	"""
+	tips = self.ref_tips()
+	try:
+	    old_tips = self['state update-tips'].split()
+	except KeyError:
+	    old_tips = []
+	if tips == old_tips:
+	    return
+
+	count = 0
+	for commit_sha1, tree_sha1, parents in \
+		self.new_commits(tips, old_tips):
+	    if not self.has_key('graph ' + commit_sha1):
+		self.add_to_graph(commit_sha1, parents)
+	    if self.has_key('commit ' + commit_sha1):
+		continue
+	    print 'Caching commit ' + commit_sha1
+	    self.add_tree(tree_sha1)
+	    self['commit ' + commit_sha1] = tree_sha1
+	    count += 1
+	    if count % 100 == 0:
+		self.commit()
+	self['state update-tips'] = ' '.join(tips)
+	self.commit()
@@ -0,0 +1,214 @@
+#!/usr/bin/python
+
+"""Persistent reader for git objects
+
+  Copyright (C) 2009  Andreas Gruenbacher <agruen@suse.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this library; if not, write to the Free Software Foundation,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import subprocess
+import threading
+import hashlib
+from subprocess import PIPE
+from binascii import hexlify
+
+#-----------------------------------------------------------------------
+
+def parse_tree(data):
+    """Parse the raw contents of a tree object.  Returns a list of
+    (mode, type, sha1, name) tuples like 'git ls-tree -z' would.
+    """
+    entries = []
+    pos = 0
+    while pos < len(data):
+	space = data.index(' ', pos)
+	nul = data.index('\0', space)
+	mode = data[pos:space].zfill(6)
+	name = data[space + 1:nul]
+	sha1 = hexlify(data[nul + 1:nul + 21])
+	pos = nul + 21
+	if mode == '040000':
+	    type = 'tree'
+	elif mode == '160000':
+	    type = 'commit'
+	else:
+	    type = 'blob'
+	entries.append((mode, type, sha1, name))
+    return entries
+
+class GitCatFile:
+    """Long-lived 'git cat-file --batch' and 'git cat-file --batch-check'
+    sessions, so that reading an object does not cost a new process.  The
+    sessions are started on first use, and restarted if they die.
+    """
+    def __init__(self, opt_git):
+	self.opt_git = opt_git
+	self.procs = {}
+	# Called when an object is missing; returns True if objects were
+	# made available that may include the missing one.
+	self.missing_hook = None
+	self.lock = threading.RLock()
+
+    def session(self, option):
+	proc = self.procs.get(option)
+	if proc == None or proc.poll() != None:
+	    cmd = [self.opt_git, 'cat-file', option]
+	    proc = subprocess.Popen(cmd, stdin=PIPE, stdout=PIPE, bufsize=-1)
+	    self.procs[option] = proc
+	return proc
+
+    def kill(self, option):
+	proc = self.procs.pop(option, None)
+	if proc != None:
+	    try:
+		proc.stdin.close()
+		proc.stdout.close()
+	    except IOError:
+		pass
+	    proc.wait()
+
+    def close(self):
+	for option in self.procs.keys():
+	    self.kill(option)
+
+    def query(self, option, obj):
+	"""Look up an object in one of the sessions.  Returns the session
+	and the object's [sha1, type, size], or None if the object does
+	not exist.
+	"""
+	if '\n' in obj:
+	    raise IOError("Invalid object name '%s'" % obj)
+	retried = False
+	while True:
+	    proc = self.session(option)
+	    try:
+		proc.stdin.write(obj + '\n')
+		proc.stdin.flush()
+		header = proc.stdout.readline()
+	    except IOError:
+		header = ''
+	    if header == '':
+		# The child has died: start a new one and try again.
+		self.kill(option)
+		if retried:
+		    raise IOError("git cat-file %s: lost connection" % option)
+		retried = True
+		continue
+	    fields = header.rstrip('\n').split(' ')
+	    if len(fields) == 3 and fields[1] != 'missing':
+		fields[2] = int(fields[2])
+		return proc, fields
+	    if self.missing_hook and not retried and self.missing_hook():
+		retried = True
+		continue
+	    return proc, None
+
+    def info(self, obj):
+	"""Return the [sha1, type, size] of an object, or None if the object
+	does not exist."""
+	with self.lock:
+	    proc, info = self.query('--batch-check', obj)
+	    return info
+
+    def lookup(self, obj, type):
+	proc, info = self.query('--batch', obj)
+	if info == None:
+	    raise IOError('Object %s does not exist' % obj)
+	if info[1] != type:
+	    self.skip(proc, info[2])
+	    raise IOError('Object %s is a %s, not a %s' % (obj, info[1], type))
+	return proc, info
+
+    def skip(self, proc, size):
+	while size > 0:
+	    data = proc.stdout.read(min(size, 65536))
+	    if len(data) == 0:
+		return
+	    size -= len(data)
+	proc.stdout.read(1)
+
+    def read(self, obj, type):
+	"""Return the contents of an object of the given type."""
+	with self.lock:
+	    proc, info = self.lookup(obj, type)
+	    data = proc.stdout.read(info[2])
+	    proc.stdout.read(1)
+	    return data
+
+    def stream(self, obj, type, chunk_size=16384):
+	"""Iterate over the contents of an object of the given type in chunks.
+	Whatever the caller does not consume is skipped when the iterator is
+	closed.  The session is locked until then."""
+	self.lock.acquire()
+	try:
+	    proc, info = self.lookup(obj, type)
+	except:
+	    self.lock.release()
+	    raise
+	size = info[2]
+	try:
+	    while size > 0:
+		data = proc.stdout.read(min(size, chunk_size))
+		if len(data) == 0:
+		    self.kill('--batch')
+		    raise IOError('Object %s: unexpected end of file' % obj)
+		size -= len(data)
+		yield data
+	finally:
+	    if self.procs.get('--batch') is proc:
+		self.skip(proc, size)
+	    self.lock.release()
+
+class BlobFile:
+    """Read a blob from its own 'git cat-file blob' process, as a file
+    that can be passed to httplib as a request body.  The MD5 hash and
+    size of what has been read are computed along the way.  seek(0) starts
+    over, so a failed request can be retried."""
+    def __init__(self, opt_git, sha1):
+	self.cmd = [opt_git, 'cat-file', 'blob', sha1]
+	self.proc = None
+	self.seek(0)
+
+    def seek(self, offset):
+	if offset != 0:
+	    raise IOError('Cannot seek in a blob')
+	self.close()
+	self.proc = subprocess.Popen(self.cmd, stdout=PIPE)
+	self.hasher = hashlib.md5()
+	self.size = 0
+	self.eof = False
+
+    def read(self, size=-1):
+	data = self.proc.stdout.read(size)
+	if len(data) == 0:
+	    self.eof = True
+	self.hasher.update(data)
+	self.size += len(data)
+	return data
+
+    def hexdigest(self):
+	return self.hasher.hexdigest()
+
+    def close(self):
+	"""Wait for the git process.  If the blob has been read completely,
+	check that the process has succeeded."""
+	proc = self.proc
+	if proc != None:
+	    self.proc = None
+	    proc.stdout.close()
+	    status = proc.wait()
+	    if status != 0 and self.eof:
+		raise subprocess.CalledProcessError(status, self.cmd)
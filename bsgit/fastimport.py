@@ -0,0 +1,170 @@
+#!/usr/bin/python
+
+"""Bulk object writer based on git fast-import
+
+  Copyright (C) 2009  Andreas Gruenbacher <agruen@suse.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this library; if not, write to the Free Software Foundation,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import subprocess
+from subprocess import PIPE
+import signal
+import re
+import threading
+from bsgit.bscache import check_proc
+
+#-----------------------------------------------------------------------
+
+def quote_path(name):
+    """Quote a file name for use in a fast-import command if necessary."""
+    if name.startswith('"') or '\n' in name:
+	name = name.replace('\\', '\\\\').replace('"', '\\"') \
+		   .replace('\n', '\\n')
+	return '"' + name + '"'
+    return name
+
+def ignore_sigint():
+    # Let fast-import finish its pack when the user interrupts us: it
+    # will see the end of its input stream once we are gone.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class GitFastImport:
+    """A single 'git fast-import' stream through which all new blobs, trees
+    and commits of a run are written, so that they end up in one pack
+    instead of as thousands of loose objects.
+
+    Each object is given a mark; the marks are mapped back to SHA1 hashes
+    with get-mark.  Objects only become visible to other git commands
+    after a checkpoint.
+    """
+    def __init__(self, opt_git, ref='refs/bsgit/import'):
+	self.opt_git = opt_git
+	self.ref = ref
+	self.proc = None
+	self.next_mark = 1
+	self.dirty = False
+	# Commits in the stream can only be referred to by mark.
+	self.commit_marks = {}
+	self.lock = threading.RLock()
+
+    def stream(self):
+	if self.proc == None:
+	    self.cmd = [self.opt_git, 'fast-import', '--quiet', '--done',
+			'--force', '--date-format=raw']
+	    self.proc = subprocess.Popen(self.cmd, stdin=PIPE, stdout=PIPE,
+					 bufsize=-1, preexec_fn=ignore_sigint)
+	return self.proc
+
+    def new_mark(self):
+	mark = ':%d' % self.next_mark
+	self.next_mark += 1
+	return mark
+
+    def response(self):
+	proc = self.stream()
+	proc.stdin.flush()
+	line = proc.stdout.readline()
+	if line == '':
+	    self.proc = None
+	    check_proc(proc, self.cmd)
+	    raise IOError('git fast-import: unexpected end of file')
+	return line.rstrip('\n')
+
+    def get_mark(self, mark):
+	"""Return the SHA1 hash of a marked object."""
+	with self.lock:
+	    self.stream().stdin.write('get-mark %s\n' % mark)
+	    return self.response()
+
+    def blob(self, file, size):
+	"""Write a blob of the given size read from file.  Returns the SHA1
+	hash of the blob."""
+	with self.lock:
+	    proc = self.stream()
+	    mark = self.new_mark()
+	    proc.stdin.write('blob\nmark %s\ndata %d\n' % (mark, size))
+	    while size > 0:
+		data = file.read(min(size, 16384))
+		if len(data) == 0:
+		    raise IOError('Blob shorter than expected')
+		proc.stdin.write(data)
+		size -= len(data)
+	    proc.stdin.write('\n')
+	    self.dirty = True
+	    return self.get_mark(mark)
+
+    def commit(self, tree, parents, author, committer, message):
+	"""Write a commit.  TREE is either the SHA1 hash of an existing tree
+	or a list of files ({'name': ..., 'sha1': ...}); AUTHOR and COMMITTER
+	are 'name <email> time timezone' identities.  Returns the SHA1 hashes
+	of the commit and its tree.
+	"""
+	with self.lock:
+	    proc = self.stream()
+	    mark = self.new_mark()
+	    if not parents:
+		proc.stdin.write('reset %s\n' % self.ref)
+	    proc.stdin.write('commit %s\nmark %s\n' % (self.ref, mark))
+	    proc.stdin.write('author %s\ncommitter %s\n' % (author, committer))
+	    proc.stdin.write('data %d\n%s\n' % (len(message), message))
+	    for n, parent in enumerate(parents):
+		parent = self.commit_marks.get(parent, parent)
+		if n == 0:
+		    proc.stdin.write('from %s\n' % parent)
+		else:
+		    proc.stdin.write('merge %s\n' % parent)
+	    proc.stdin.write('deleteall\n')
+	    if isinstance(tree, str):
+		proc.stdin.write('M 040000 %s ""\n' % tree)
+	    else:
+		for file in tree:
+		    proc.stdin.write('M 100644 %s %s\n' %
+				     (file['sha1'], quote_path(file['name'])))
+	    self.dirty = True
+	    commit_sha1 = self.get_mark(mark)
+	    self.commit_marks[commit_sha1] = mark
+	    if isinstance(tree, str):
+		tree_sha1 = tree
+	    else:
+		proc.stdin.write('ls %s ""\n' % mark)
+		tree_sha1 = re.match('^040000 tree ([0-9a-f]{40})\t',
+				     self.response()).group(1)
+	    return commit_sha1, tree_sha1
+
+    def checkpoint(self):
+	"""Make all objects written so far visible to other git commands.
+	Returns True if there was anything to write."""
+	with self.lock:
+	    if not self.dirty:
+		return False
+	    self.stream().stdin.write('checkpoint\nprogress checkpoint\n')
+	    while self.response() != 'progress checkpoint':
+		pass
+	    self.dirty = False
+	    return True
+
+    def close(self):
+	"""Finish the stream, and remove the scratch ref again."""
+	with self.lock:
+	    if self.proc != None:
+		proc = self.proc
+		self.proc = None
+		proc.stdin.write('reset %s\nfrom %s\ndone\n' %
+				 (self.ref, '0' * 40))
+		proc.stdin.close()
+		proc.stdout.close()
+		check_proc(proc, self.cmd)
+		self.dirty = False
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+
+"""Compact representation of build service package histories
+
+  Copyright (C) 2009  Andreas Gruenbacher <agruen@suse.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this library; if not, write to the Free Software Foundation,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+from bisect import bisect_right
+
+#-----------------------------------------------------------------------
+
+class Revision(object):
+    """A revision of a package.  The parent of a revision is referred to by
+    its index in the history of the package.
+
+    Revisions which are not part of the history (expanded versions of
+    links) have no rev; they still have a parent in the history.
+    """
+    __slots__ = ('history', 'parent_index', 'rev', 'srcmd5', 'time', 'user',
+		 'comment', 'commit_sha1', 'base_sha1', 'need_to_fetch')
+
+    def __init__(self, history, parent_index, rev=None, srcmd5=None,
+		 time=None, user=None, comment=None):
+	self.history = history
+	self.parent_index = parent_index
+	self.rev = rev
+	self.srcmd5 = srcmd5
+	self.time = time
+	self.user = user
+	self.comment = comment
+	self.commit_sha1 = None
+	self.base_sha1 = None
+	self.need_to_fetch = False
+
+    def parent(self):
+	"""Return the parent revision, or None for the first revision."""
+	if self.parent_index == None:
+	    return None
+	return self.history.revisions[self.parent_index]
+
+class History:
+    """The revisions of a package, oldest first, with maps from rev and
+    srcmd5 to the index of a revision.  (When more than one revision has
+    the same srcmd5, the srcmd5 maps to the first such revision.)
+    """
+    def __init__(self, records=[], known={}):
+	"""Create a history from (rev, srcmd5, time, user, comment) records.
+	KNOWN maps the revs of revisions which have been fetched already to
+	their commits; the revisions after a known revision are marked as
+	needed, so that they get connected to it."""
+	self.revisions = []
+	self.rev_index = {}
+	self.srcmd5_index = {}
+	self.times = None
+	need_to_fetch = False
+	for record in records:
+	    index = len(self.revisions)
+	    if index == 0:
+		parent_index = None
+	    else:
+		parent_index = index - 1
+	    revision = Revision(self, parent_index, *record)
+	    self.revisions.append(revision)
+	    self.rev_index[revision.rev] = index
+	    if revision.srcmd5 not in self.srcmd5_index:
+		self.srcmd5_index[revision.srcmd5] = index
+
+	    revision.need_to_fetch = need_to_fetch
+	    if revision.rev in known:
+		revision.commit_sha1 = known[revision.rev]
+		need_to_fetch = True
+
+    def lookup(self, rev):
+	"""Return the revision with the given rev or srcmd5 (or the latest
+	revision), or None."""
+	if rev == 'latest':
+	    if self.revisions:
+		return self.revisions[-1]
+	    return None
+	index = self.rev_index.get(rev)
+	if index == None:
+	    index = self.srcmd5_index.get(rev)
+	    if index == None:
+		return None
+	return self.revisions[index]
+
+    def lookup_time(self, time):
+	"""Return the latest revision at or before TIME, or None.  This is the
+	last revision in the history whose time is not after TIME, which is
+	what walking back from the latest revision would find."""
+	if self.times == None:
+	    self.index_times()
+	n = bisect_right(self.times, int(time))
+	if n == 0:
+	    return None
+	return self.revisions[self.time_indexes[n - 1]]
+
+    def index_times(self):
+	# The times of the revisions in numeric order, and for each of them
+	# the highest index of a revision at or before that time.  (Revision
+	# times are not necessarily in order.)
+	pairs = sorted([(int(revision.time), index)
+			for index, revision in enumerate(self.revisions)])
+	time_indexes = []
+	latest = -1
+	for time, index in pairs:
+	    latest = max(latest, index)
+	    time_indexes.append(latest)
+	self.time_indexes = time_indexes
+	self.times = [time for time, index in pairs]
+
+    def mark_as_needed(self, rev, revision):
+	"""Mark the revisions from rev up to revision as needed.  Returns
+	False if rev is not an ancestor of revision (or revision itself)."""
+	start = self.rev_index.get(rev)
+	end = self.rev_index.get(revision.rev)
+	if start == None or end == None or start > end:
+	    return False
+	for index in range(start, end + 1):
+	    self.revisions[index].need_to_fetch = True
+	return True
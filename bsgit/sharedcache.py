@@ -0,0 +1,147 @@
+#!/usr/bin/python
+
+"""Download cache shared between repositories
+
+  Copyright (C) 2009  Andreas Gruenbacher <agruen@suse.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this library; if not, write to the Free Software Foundation,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import os
+import time
+import fcntl
+import threading
+from errno import ENOENT, EEXIST
+from tempfile import NamedTemporaryFile
+
+#-----------------------------------------------------------------------
+
+def make_dirs(path):
+    try:
+	os.makedirs(path)
+    except OSError, error:
+	if error.errno != EEXIST:
+	    raise
+
+class SharedCache:
+    """A directory of verified build service files, named by their MD5
+    hashes (objects/<xx>/<rest of md5>), which any number of bsgit
+    processes can use at the same time.
+
+    Files are written under tmp/ and renamed into place once they are
+    complete and verified, so readers never see partial files.  Reading
+    a file marks it as recently used (by setting its mtime); when the
+    cache grows beyond max_size bytes, the least recently used files are
+    removed.
+    """
+    def __init__(self, directory, max_size):
+	self.directory = directory
+	self.max_size = max_size
+	self.added = 0
+	self.lock = threading.Lock()
+	make_dirs(os.path.join(directory, 'objects'))
+	make_dirs(os.path.join(directory, 'tmp'))
+
+    def path(self, md5):
+	return os.path.join(self.directory, 'objects', md5[0:2], md5[2:])
+
+    def lookup(self, md5):
+	"""Return an open file with the contents of md5 and its size, or
+	None."""
+	path = self.path(md5)
+	try:
+	    file = open(path, 'rb')
+	except IOError, error:
+	    if error.errno == ENOENT:
+		return None
+	    raise
+	try:
+	    os.utime(path, None)
+	except OSError:
+	    # Evicted in the meantime; we still have it open.
+	    pass
+	return file, os.fstat(file.fileno()).st_size
+
+    def new_file(self):
+	"""Return a temporary file to download a file into; see add() and
+	discard()."""
+	return NamedTemporaryFile(dir=os.path.join(self.directory, 'tmp'),
+				  delete=False)
+
+    def add(self, md5, tmp):
+	"""Move a downloaded and verified temporary file into the cache.  The
+	file remains open."""
+	tmp.flush()
+	path = self.path(md5)
+	make_dirs(os.path.dirname(path))
+	os.rename(tmp.name, path)
+	with self.lock:
+	    self.added += os.fstat(tmp.fileno()).st_size
+	    if self.added < self.max_size / 10:
+		return
+	    self.added = 0
+	self.evict()
+
+    def discard(self, tmp):
+	"""Get rid of a temporary file which did not make it into the cache."""
+	tmp.close()
+	try:
+	    os.unlink(tmp.name)
+	except OSError:
+	    pass
+
+    def evict(self):
+	"""Remove the least recently used files until the cache is no larger
+	than max_size.  Only one process evicts at a time; the others skip
+	this."""
+	lock = open(os.path.join(self.directory, 'lock'), 'w')
+	try:
+	    try:
+		fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+	    except IOError:
+		return
+	    now = time.time()
+	    files = []
+	    total = 0
+	    for dirpath, dirnames, filenames in os.walk(self.directory):
+		for name in filenames:
+		    path = os.path.join(dirpath, name)
+		    try:
+			st = os.stat(path)
+		    except OSError:
+			continue
+		    if dirpath == os.path.join(self.directory, 'tmp'):
+			# Left behind by processes which died.
+			if now - st.st_mtime > 24 * 60 * 60:
+			    os.unlink(path)
+			continue
+		    if dirpath != self.directory:
+			files.append((st.st_mtime, st.st_size, path))
+			total += st.st_size
+	    files.sort()
+	    for mtime, size, path in files:
+		if total <= self.max_size:
+		    break
+		try:
+		    os.unlink(path)
+		except OSError:
+		    pass
+		total -= size
+	finally:
+	    lock.close()
+
+    def close(self):
+	if self.added:
+	    self.evict()
@@ -0,0 +1,183 @@
+#!/usr/bin/python
+
+"""Storage engines for the build service cache
+
+  Copyright (C) 2009  Andreas Gruenbacher <agruen@suse.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this library; if not, write to the Free Software Foundation,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import sqlite3
+try:
+    import bsddb
+except ImportError:
+    try:
+	import bsddb3 as bsddb
+    except ImportError:
+	bsddb = None
+
+#-----------------------------------------------------------------------
+
+# The kinds of objects in the cache.  Keys of other kinds end up in the
+# 'other' table.
+TABLES = ('blob', 'tree', 'manifest', 'commit', 'graph', 'revision', 'history',
+	  'baserev', 'missing', 'email', 'login', 'realname', 'response',
+	  'state', 'other')
+
+def prefix_end(prefix):
+    """Return the smallest string greater than all strings starting with
+    prefix."""
+    prefix = prefix.rstrip('\xff')
+    if prefix == '':
+	return '\xff' * 64
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+class SqliteStorage:
+    """SQLite storage engine with one table per kind of object.  Changes
+    are only made permanent by commit().
+    """
+    def __init__(self, name):
+	self.name = name
+	self.db = sqlite3.connect(name, check_same_thread=False)
+	self.db.text_factory = str
+	self.db.execute('PRAGMA journal_mode=WAL')
+	self.db.execute('PRAGMA synchronous=NORMAL')
+	for table in TABLES:
+	    self.db.execute('CREATE TABLE IF NOT EXISTS "%s" '
+			    '(key TEXT PRIMARY KEY, value TEXT NOT NULL)' % table)
+	# For finding all email addresses of a login, and the MD5 hash of
+	# a blob SHA1.
+	self.db.execute('CREATE INDEX IF NOT EXISTS login_value '
+			'ON login (value)')
+	self.db.execute('CREATE INDEX IF NOT EXISTS blob_value '
+			'ON blob (value)')
+	self.db.commit()
+
+    def get(self, table, key):
+	row = self.db.execute('SELECT value FROM "%s" WHERE key = ?' % table,
+			      (key,)).fetchone()
+	if row == None:
+	    raise KeyError(key)
+	return row[0]
+
+    def put(self, table, key, value):
+	self.db.execute('INSERT OR REPLACE INTO "%s" (key, value) '
+			'VALUES (?, ?)' % table, (key, value))
+
+    def delete(self, table, key):
+	cursor = self.db.execute('DELETE FROM "%s" WHERE key = ?' % table,
+				 (key,))
+	if cursor.rowcount == 0:
+	    raise KeyError(key)
+
+    def items(self, table, prefix=''):
+	"""Iterate over the (key, value) pairs of a table in key order,
+	optionally only over the keys starting with prefix."""
+	if prefix == '':
+	    return self.db.execute('SELECT key, value FROM "%s" ORDER BY key' %
+				   table)
+	# A range scan on the primary key index.
+	return self.db.execute('SELECT key, value FROM "%s" '
+			       'WHERE key >= ? AND key < ? ORDER BY key' % table,
+			       (prefix, prefix_end(prefix)))
+
+    def get_many(self, table, keys):
+	"""Return a dict with the values of those keys which exist."""
+	keys = list(keys)
+	values = {}
+	# SQLite limits the number of parameters of a statement.
+	for n in range(0, len(keys), 500):
+	    chunk = keys[n:n + 500]
+	    cursor = self.db.execute('SELECT key, value FROM "%s" '
+				     'WHERE key IN (%s)' %
+				     (table, ', '.join(['?'] * len(chunk))),
+				     chunk)
+	    values.update(cursor)
+	return values
+
+    def find(self, table, value):
+	"""Return the keys in a table which map to value, in key order."""
+	cursor = self.db.execute('SELECT key FROM "%s" WHERE value = ? '
+				 'ORDER BY key' % table, (value,))
+	return [row[0] for row in cursor]
+
+    def commit(self):
+	self.db.commit()
+
+    def close(self):
+	self.db.commit()
+	self.db.close()
+
+class BsddbStorage:
+    """Storage engine for the original Berkeley DB hash format, where all
+    kinds of objects share one hash and keys are prefixed with their kind.
+    There are no indexes, so scans go through the entire hash.
+    """
+    def __init__(self, name):
+	if bsddb == None:
+	    raise IOError('Cannot open %s: the bsddb module is not available'
+			  % name)
+	self.name = name
+	self.hash = bsddb.hashopen(name)
+
+    def hash_key(self, table, key):
+	if table == 'other':
+	    return key
+	return table + ' ' + key
+
+    def get(self, table, key):
+	return self.hash[self.hash_key(table, key)]
+
+    def put(self, table, key, value):
+	self.hash[self.hash_key(table, key)] = value
+
+    def delete(self, table, key):
+	del self.hash[self.hash_key(table, key)]
+
+    def items(self, table, prefix=''):
+	keys = []
+	for key in self.hash.keys():
+	    kind, rest = (key.split(' ', 1) + [''])[0:2]
+	    if kind not in TABLES or kind == 'other':
+		kind, rest = 'other', key
+	    if kind == table and rest.startswith(prefix):
+		keys.append(rest)
+	for key in sorted(keys):
+	    yield key, self.get(table, key)
+
+    def get_many(self, table, keys):
+	values = {}
+	for key in keys:
+	    hash_key = self.hash_key(table, key)
+	    if self.hash.has_key(hash_key):
+		values[key] = self.hash[hash_key]
+	return values
+
+    def find(self, table, value):
+	return [key for key, v in self.items(table) if v == value]
+
+    def commit(self):
+	self.hash.sync()
+
+    def close(self):
+	self.hash.close()
+
+ENGINES = {'sqlite': SqliteStorage, 'bsddb': BsddbStorage}
+
+def open_storage(name, engine='sqlite'):
+    """Open (or create) a cache database with the given storage engine."""
+    if engine not in ENGINES:
+	raise IOError("Unknown storage engine '%s'" % engine)
+    return ENGINES[engine](name)
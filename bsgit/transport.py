@@ -0,0 +1,309 @@
+#!/usr/bin/python
+
+"""Persistent HTTP connections to the build service
+
+  Copyright (C) 2009  Andreas Gruenbacher <agruen@suse.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this library; if not, write to the Free Software Foundation,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import httplib
+import socket
+import base64
+import threading
+import time
+import urllib
+from urlparse import urlsplit, urljoin
+from urllib2 import HTTPError
+from StringIO import StringIO
+
+#-----------------------------------------------------------------------
+
+# Methods which can safely be sent again when a kept-alive connection fails.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+class ConnectionPool:
+    """Keep-alive connections to one server.  At most max_connections
+    requests are in flight at the same time; further requests wait for a
+    connection to become free.
+
+    With a proxy (a URL like http://[user:password@]host:port), plain HTTP
+    requests are sent to the proxy, and HTTPS connections are tunneled
+    through it.  CONTEXT is the ssl.SSLContext for HTTPS connections (None
+    for the default, which verifies certificates).
+    """
+    def __init__(self, scheme, netloc, max_connections, proxy=None,
+		 context=None):
+	self.scheme = scheme
+	self.netloc = netloc
+	self.context = context
+	self.proxy = None
+	self.proxy_headers = {}
+	if proxy:
+	    parts = urlsplit(proxy)
+	    self.proxy = parts.hostname
+	    if parts.port:
+		self.proxy += ':%d' % parts.port
+	    if parts.username != None:
+		self.proxy_headers['Proxy-Authorization'] = 'Basic ' + \
+		    base64.b64encode('%s:%s' % (urllib.unquote(parts.username),
+						urllib.unquote(parts.password or '')))
+	self.idle = []
+	self.slots = threading.Semaphore(max_connections)
+	self.lock = threading.Lock()
+	self.opened = 0
+
+    def get(self, reuse=True):
+	"""Return a connection and whether it was used before.  Without
+	REUSE, a new connection is opened."""
+	self.slots.acquire()
+	with self.lock:
+	    if self.idle and reuse:
+		return self.idle.pop(), True
+	    self.opened += 1
+	return self.connect(), False
+
+    def connect(self):
+	if self.scheme == 'https':
+	    if self.proxy:
+		conn = httplib.HTTPSConnection(self.proxy, context=self.context)
+		conn.set_tunnel(self.netloc, headers=self.proxy_headers)
+		return conn
+	    return httplib.HTTPSConnection(self.netloc, context=self.context)
+	return httplib.HTTPConnection(self.proxy or self.netloc)
+
+    def request_path(self, path):
+	"""Return what to put in the request line for PATH, and the headers
+	the proxy needs."""
+	if self.proxy and self.scheme == 'http':
+	    return 'http://' + self.netloc + path, self.proxy_headers
+	return path, {}
+
+    def put(self, conn, reuse):
+	if reuse:
+	    with self.lock:
+		self.idle.append(conn)
+	else:
+	    conn.close()
+	self.slots.release()
+
+    def close(self):
+	with self.lock:
+	    for conn in self.idle:
+		conn.close()
+	    self.idle = []
+
+class Response:
+    """The body of a response.  The connection goes back to its pool once
+    the body has been read completely, or when the response is closed."""
+    def __init__(self, transport, pool, conn, response, request):
+	self.transport = transport
+	self.pool = pool
+	self.conn = conn
+	self.response = response
+	self.request = request
+	self.status = response.status
+	self.size = 0
+
+    def getheader(self, name, default=None):
+	return self.response.getheader(name, default)
+
+    def read(self, size=None):
+	if self.conn == None:
+	    return ''
+	try:
+	    if size == None:
+		data = self.response.read()
+	    else:
+		data = self.response.read(size)
+	except:
+	    self.release(False)
+	    raise
+	self.size += len(data)
+	if self.response.isclosed():
+	    self.release(not self.response.will_close)
+	return data
+
+    def close(self):
+	if self.conn != None:
+	    # An unfinished body would get in the way of the next request.
+	    self.release(self.response.isclosed() and
+			 not self.response.will_close)
+
+    def release(self, reuse):
+	conn = self.conn
+	self.conn = None
+	self.pool.put(conn, reuse)
+	self.transport.count(self.request, self.size)
+
+class RecordingFile:
+    """Keep a copy of everything read from a file."""
+    def __init__(self, file):
+	self.file = file
+	self.chunks = []
+
+    def read(self, size=None):
+	data = self.file.read(size)
+	self.chunks.append(data)
+	return data
+
+    def getvalue(self):
+	return ''.join(self.chunks)
+
+class HTTPTransport:
+    """HTTP/1.1 requests over a pool of keep-alive connections per server,
+    so that a fetch does not pay for a new connection (and TLS handshake)
+    for each request.  Requests from several threads run concurrently, up
+    to max_connections per server.
+
+    Failed requests (status 400 and above) raise urllib2.HTTPError like
+    urllib2 would.  The time and size of all requests is counted by
+    method (see summary()).
+
+    Proxies are taken from the environment (http_proxy, https_proxy and
+    no_proxy) like urllib does, unless PROXIES ({scheme: url}, with the
+    hosts not to use a proxy for under 'no') is given.  Only HTTP Basic authentication is
+    supported.
+    """
+    def __init__(self, max_connections=8, credentials=None, ssl_context=None,
+		 proxies=None):
+	self.max_connections = max_connections
+	# Called with the scheme://host part of a URL; returns a (user,
+	# password) tuple or None.
+	self.credentials = credentials
+	# Called with the scheme://host part of an https URL; returns an
+	# ssl.SSLContext or None.
+	self.ssl_context = ssl_context
+	if proxies == None:
+	    proxies = urllib.getproxies()
+	self.proxies = proxies
+	self.pools = {}
+	self.auth = {}
+	self.stats = {}
+	self.lock = threading.Lock()
+
+    def pool(self, scheme, netloc):
+	with self.lock:
+	    key = scheme + '://' + netloc
+	    if key not in self.pools:
+		proxy = self.proxies.get(scheme)
+		if proxy and urllib.proxy_bypass_environment(netloc,
+							     self.proxies):
+		    proxy = None
+		context = None
+		if scheme == 'https' and self.ssl_context:
+		    context = self.ssl_context(key)
+		self.pools[key] = ConnectionPool(scheme, netloc,
+						 self.max_connections,
+						 proxy, context)
+		self.auth[key] = None
+		if self.credentials:
+		    credentials = self.credentials(key)
+		    if credentials and credentials[0] != None:
+			self.auth[key] = 'Basic ' + \
+			    base64.b64encode('%s:%s' % credentials)
+	    return self.pools[key], self.auth[key]
+
+    def count(self, request, size):
+	method, url, start = request
+	with self.lock:
+	    stats = self.stats.setdefault(method, [0, 0, 0.0])
+	    stats[0] += 1
+	    stats[1] += size
+	    stats[2] += time.time() - start
+
+    def request(self, method, url, data=None, headers={}):
+	"""Make a request, and return the response body as a file-like
+	object.  GET requests follow redirects.  DATA can also be a file to
+	send the request body from; a Content-Length header must then be
+	given, and the body is streamed rather than read into memory."""
+	for redirect in range(5):
+	    response = self.request_once(method, url, data, headers)
+	    location = response.getheader('location')
+	    if method != 'GET' or response.status not in (301, 302, 303, 307) \
+	       or location == None:
+		break
+	    response.close()
+	    url = urljoin(url, location)
+	if response.status >= 400:
+	    headers = response.response.msg
+	    body = StringIO(response.read())
+	    raise HTTPError(url, response.status, response.response.reason,
+			    headers, body)
+	return response
+
+    def request_once(self, method, url, data, extra_headers):
+	start = time.time()
+	parts = urlsplit(url)
+	pool, auth = self.pool(parts.scheme, parts.netloc)
+	path = parts.path or '/'
+	if parts.query:
+	    path += '?' + parts.query
+	path, proxy_headers = pool.request_path(path)
+	headers = {'User-Agent': 'bsgit'}
+	headers.update(proxy_headers)
+	if auth:
+	    headers['Authorization'] = auth
+	if data != None:
+	    headers['Content-Type'] = 'application/octet-stream'
+	headers.update(extra_headers)
+
+	# When a kept-alive connection fails, we cannot tell if the server
+	# closed it while it was idle, or after handling the request.  Other
+	# requests (like POST) must not be sent twice, so they go out on a new
+	# connection.
+	idempotent = method in IDEMPOTENT_METHODS
+	while True:
+	    conn, reused = pool.get(idempotent)
+	    try:
+		conn.request(method, path, data, headers)
+		response = conn.getresponse()
+		break
+	    except (httplib.HTTPException, socket.error):
+		pool.put(conn, False)
+		# The server may have closed an idle connection; retry once
+		# on a fresh one.  A request body which is a file must be
+		# sent again from the start.
+		if not reused:
+		    raise
+		if hasattr(data, 'read'):
+		    data.seek(0)
+	return Response(self, pool, conn, response, (method, url, start))
+
+    def get(self, url, headers={}):
+	return self.request('GET', url, headers=headers)
+
+    def put(self, url, data, headers={}):
+	return self.request('PUT', url, data, headers)
+
+    def post(self, url, data):
+	return self.request('POST', url, data)
+
+    def summary(self):
+	"""Return a description of the requests made so far."""
+	with self.lock:
+	    opened = sum([pool.opened for pool in self.pools.values()])
+	    lines = ['%d connections' % opened]
+	    for method in sorted(self.stats.keys()):
+		count, size, seconds = self.stats[method]
+		lines.append('%-4s %6d requests %12d bytes %8.1fs '
+			     '(%.3fs per request)' %
+			     (method, count, size, seconds, seconds / count))
+	return '\n'.join(lines)
+
+    def close(self):
+	with self.lock:
+	    for pool in self.pools.values():
+		pool.close()
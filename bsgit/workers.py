@@ -0,0 +1,139 @@
+#!/usr/bin/python
+
+"""Simple thread pool helpers
+
+  Copyright (C) 2009  Andreas Gruenbacher <agruen@suse.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this library; if not, write to the Free Software Foundation,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import sys
+import threading
+import Queue
+
+#-----------------------------------------------------------------------
+
+def join_threads(threads):
+    # Thread.join() without a timeout cannot be interrupted.
+    for thread in threads:
+	while thread.isAlive():
+	    thread.join(0.1)
+
+def run_parallel(function, items, jobs):
+    """Call function(item) for each item in up to JOBS threads, and return
+    the results in the order of the items.  When a call fails, no further
+    items are started, and the first exception (in item order) is re-raised
+    once the running calls have finished.
+    """
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+	return [function(item) for item in items]
+
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    queue = Queue.Queue()
+    for n in range(len(items)):
+	queue.put(n)
+    failed = threading.Event()
+
+    def worker():
+	while not failed.isSet():
+	    try:
+		n = queue.get_nowait()
+	    except Queue.Empty:
+		return
+	    try:
+		results[n] = function(items[n])
+	    except:
+		errors[n] = sys.exc_info()
+		failed.set()
+
+    threads = []
+    for n in range(min(jobs, len(items))):
+	thread = threading.Thread(target=worker)
+	thread.setDaemon(True)
+	thread.start()
+	threads.append(thread)
+    join_threads(threads)
+
+    for error in errors:
+	if error != None:
+	    raise error[0], error[1], error[2]
+    return results
+
+def dependency_levels(items, dependencies):
+    """Split items into levels, so that each item only depends on items in
+    earlier levels (dependencies[item] is the set of items it depends on;
+    other dependencies are ignored).  The items in a level can be worked
+    on in parallel.  Items in dependency cycles end up together in the
+    last level, which must then be worked on one item at a time.
+    """
+    pending = list(items)
+    levels = []
+    while pending:
+	unfinished = set(pending)
+	level = [item for item in pending
+		 if not [dependency for dependency in dependencies.get(item, ())
+			 if dependency != item and dependency in unfinished]]
+	if not level:
+	    levels.append(pending)
+	    break
+	levels.append(level)
+	level = set(level)
+	pending = [item for item in pending if item not in level]
+    return levels
+
+def prefetch(function, items, ahead):
+    """Iterate over items, and call function(item) in a background thread
+    up to AHEAD items before the item is returned.  The function is only
+    expected to warm up caches: its result is ignored, and when it fails,
+    the item is still returned (the caller will run into the same error
+    itself).  Each item is returned once its function call has finished.
+    """
+    items = list(items)
+    if ahead <= 0:
+	for item in items:
+	    yield item
+	return
+
+    done = [threading.Event() for item in items]
+    slots = threading.Semaphore(ahead)
+    stopped = threading.Event()
+
+    def worker():
+	for n in range(len(items)):
+	    slots.acquire()
+	    if stopped.isSet():
+		return
+	    try:
+		function(items[n])
+	    except Exception:
+		pass
+	    done[n].set()
+
+    thread = threading.Thread(target=worker)
+    thread.setDaemon(True)
+    thread.start()
+    try:
+	for n in range(len(items)):
+	    # Event.wait() without a timeout cannot be interrupted.
+	    while not done[n].isSet():
+		done[n].wait(0.1)
+	    slots.release()
+	    yield items[n]
+    finally:
+	stopped.set()
+	slots.release()
+	join_threads([thread])
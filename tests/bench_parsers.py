@@ -0,0 +1,149 @@
+#!/usr/bin/python
+
+"""Benchmark the streaming directory and revisionlist parsers
+
+  Compares the peak RSS and wall time of the streaming parsers in bsgit.py
+  with building the whole ElementTree first, on large synthetic documents.
+  Each measurement runs in a process of its own.
+
+  Usage: bench_parsers.py [revisions-and-entries]
+
+  Copyright (C) 2009  Andreas Gruenbacher <agruen@suse.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this library; if not, write to the Free Software Foundation,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import os
+import sys
+import imp
+import time
+import resource
+import subprocess
+import tempfile
+from subprocess import PIPE
+
+#-----------------------------------------------------------------------
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def write_revisionlist(file, count):
+    file.write('<revisionlist>\n')
+    for n in range(1, count + 1):
+	file.write('  <revision rev="%d" vrev="%d">\n'
+		   '    <srcmd5>%032x</srcmd5>\n'
+		   '    <version>1.%d</version>\n'
+		   '    <time>%d</time>\n'
+		   '    <user>user%d</user>\n'
+		   '    <comment>Revision %d of a package with a rather long '
+		   'history, and a comment of typical length.</comment>\n'
+		   '  </revision>\n' %
+		   (n, n, n, n, 1230000000 + n * 60, n % 50, n))
+    file.write('</revisionlist>\n')
+
+def write_directory(file, count):
+    file.write('<directory name="package" rev="7" srcmd5="%032x">\n' % 7)
+    file.write('  <linkinfo project="p" package="k" srcmd5="%032x" '
+	       'baserev="%032x"/>\n' % (1, 2))
+    for n in range(count):
+	file.write('  <entry name="file-%d.patch" md5="%032x" size="%d" '
+		   'mtime="%d"/>\n' % (n, n, n * 7, 1230000000 + n))
+    file.write('</directory>\n')
+
+def tree_revisionlist(bsgit, file):
+    # What get_revisions() did before: build the tree, then walk it.
+    root = bsgit.ET.parse(file).getroot()
+    records = []
+    for node in root.findall('revision'):
+	record = [node.get('rev')]
+	for name in bsgit.HISTORY_FIELDS[1:]:
+	    value = node.find(name)
+	    if value != None:
+		value = value.text
+	    record.append(value)
+	records.append(tuple(record))
+    return records
+
+def tree_directory(bsgit, file):
+    # What parse_xml_directory() did before.
+    root = bsgit.ET.parse(file).getroot()
+    status = {}
+    for name in ('rev', 'srcmd5', 'xsrcmd5'):
+	if name in root.attrib:
+	    status[name] = root.get(name)
+    node = root.find('linkinfo')
+    if node != None:
+	status['linkinfo'] = dict(node.attrib)
+    status['files'] = [{'name': node.get('name'), 'md5': node.get('md5')}
+		       for node in root.findall('entry')]
+    return status
+
+PARSERS = {
+    'stream-revisionlist':
+	lambda bsgit, file: list(bsgit.iter_revisionlist(file)),
+    'tree-revisionlist': tree_revisionlist,
+    'stream-directory':
+	lambda bsgit, file: bsgit.parse_xml_directory(file),
+    'tree-directory': tree_directory,
+}
+
+def measure(parser, name):
+    """Parse a document, and print the wall time and peak RSS growth."""
+    sys.path.insert(0, TOP)
+    bsgit = imp.load_source('bsgit_script', os.path.join(TOP, 'bsgit.py'))
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    file = open(name)
+    result = PARSERS[parser](bsgit, file)
+    seconds = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print seconds, after - before
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == '--measure':
+	measure(sys.argv[2], sys.argv[3])
+	return
+    count = 200000
+    if len(sys.argv) == 2:
+	count = int(sys.argv[1])
+
+    documents = {}
+    try:
+	for kind, write in (('revisionlist', write_revisionlist),
+			    ('directory', write_directory)):
+	    fd, name = tempfile.mkstemp(suffix='.xml')
+	    documents[kind] = name
+	    file = os.fdopen(fd, 'w')
+	    write(file, count)
+	    file.close()
+
+	print "%-22s %10s %10s %14s" % ('parser', 'MiB', 'seconds',
+					 'peak RSS MiB')
+	for parser in sorted(PARSERS.keys()):
+	    name = documents[parser.split('-', 1)[1]]
+	    proc = subprocess.Popen([sys.executable, __file__, '--measure',
+				     parser, name], stdout=PIPE)
+	    output = proc.communicate()[0]
+	    if proc.returncode != 0:
+		sys.exit(proc.returncode)
+	    seconds, growth = output.split()
+	    print "%-22s %10.1f %10.2f %14.1f" % \
+		  (parser, os.path.getsize(name) / 1048576.0, float(seconds),
+		   int(growth) / 1024.0)
+    finally:
+	for name in documents.values():
+	    os.unlink(name)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+
+"""A fake build service HTTP server for the tests
+
+  Copyright (C) 2009  Andreas Gruenbacher <agruen@suse.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this library; if not, write to the Free Software Foundation,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import threading
+import hashlib
+import BaseHTTPServer
+import SocketServer
+
+#-----------------------------------------------------------------------
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+	self.handle_request()
+
+    def do_PUT(self):
+	self.handle_request()
+
+    def do_POST(self):
+	self.handle_request()
+
+    def handle_request(self):
+	server = self.server
+	# Read the body in chunks, as a real server would.
+	size = int(self.headers.get('content-length', 0))
+	hasher = hashlib.md5()
+	body = []
+	while size > 0:
+	    data = self.rfile.read(min(size, 65536))
+	    if not data:
+		break
+	    hasher.update(data)
+	    if len(body) < 16:
+		body.append(data)
+	    size -= len(data)
+	with server.lock:
+	    server.requests.append({'method': self.command, 'path': self.path,
+				    'headers': self.headers,
+				    'md5': hasher.hexdigest(),
+				    'body': ''.join(body),
+				    'connection': self.connection})
+	status, headers, body = server.routes.get(self.path,
+						  (404, {}, 'Not found'))
+	self.send_response(status)
+	for name, value in headers.items():
+	    self.send_header(name, value)
+	self.send_header('Content-Length', str(len(body)))
+	self.end_headers()
+	self.wfile.write(body)
+	if server.drop_connections:
+	    # Close the connection without telling the client.
+	    self.close_connection = 1
+
+    def log_message(self, *args):
+	pass
+
+class FakeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """An HTTP/1.1 server on localhost which answers requests from ROUTES
+    ({path: (status, headers, body)}) and records them in REQUESTS."""
+    daemon_threads = True
+
+    def __init__(self):
+	BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+	self.routes = {}
+	self.requests = []
+	self.drop_connections = False
+	self.lock = threading.Lock()
+	self.thread = threading.Thread(target=self.serve_forever)
+	self.thread.setDaemon(True)
+	self.thread.start()
+
+    def handle_error(self, request, client_address):
+	# Clients dropping connections are part of the tests.
+	pass
+
+    def url(self, path=''):
+	return 'http://127.0.0.1:%d%s' % (self.server_port, path)
+
+    def stop(self):
+	self.shutdown()
+	self.server_close()
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+
+"""Tests for streaming blobs out of git (bsgit.catfile)
+
+  Copyright (C) 2009  Andreas Gruenbacher <agruen@suse.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this library; if not, write to the Free Software Foundation,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import os
+import sys
+import unittest
+import hashlib
+import shutil
+import subprocess
+import tempfile
+from subprocess import PIPE
+from bsgit.catfile import GitCatFile, BlobFile
+from bsgit.transport import HTTPTransport
+from fakeserver import FakeServer
+
+#-----------------------------------------------------------------------
+
+BLOB_SIZE = 64 << 20
+
+# Upload a blob the way push_file() does, and print the MD5 hash and
+# the growth of the peak RSS in kilobytes.
+UPLOAD = '''
+import sys, resource
+from bsgit.catfile import BlobFile
+from bsgit.transport import HTTPTransport
+url, sha1, size = sys.argv[1:4]
+transport = HTTPTransport(proxies={})
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+blob = BlobFile('git', sha1)
+transport.put(url, blob, {'Content-Length': size}).read()
+blob.close()
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print blob.hexdigest(), after - before
+'''
+
+class BlobFileTest(unittest.TestCase):
+    def setUp(self):
+	self.old_cwd = os.getcwd()
+	self.repo = tempfile.mkdtemp()
+	os.chdir(self.repo)
+	subprocess.check_call(['git', 'init', '-q'])
+	self.server = FakeServer()
+	self.server.routes['/source/p/k/f'] = (200, {}, '')
+
+    def tearDown(self):
+	self.server.stop()
+	os.chdir(self.old_cwd)
+	shutil.rmtree(self.repo)
+
+    def add_blob(self, chunks):
+	"""Add a blob to the repository without holding it in memory."""
+	proc = subprocess.Popen(['git', 'hash-object', '-w', '--stdin'],
+				stdin=PIPE, stdout=PIPE)
+	hasher = hashlib.md5()
+	for data in chunks:
+	    hasher.update(data)
+	    proc.stdin.write(data)
+	proc.stdin.close()
+	sha1 = proc.stdout.read().strip()
+	self.assertEqual(proc.wait(), 0)
+	return sha1, hasher.hexdigest()
+
+    def test_read(self):
+	sha1, md5 = self.add_blob(['hello ', 'world\n'])
+	blob = BlobFile('git', sha1)
+	self.assertEqual(blob.read(3), 'hel')
+	self.assertEqual(blob.read(), 'lo world\n')
+	self.assertEqual(blob.read(), '')
+	blob.close()
+	self.assertEqual(blob.hexdigest(), md5)
+	self.assertEqual(blob.size, 12)
+
+    def test_seek_restarts(self):
+	sha1, md5 = self.add_blob(['hello world\n'])
+	blob = BlobFile('git', sha1)
+	blob.read(5)
+	blob.seek(0)
+	self.assertEqual(blob.read(), 'hello world\n')
+	blob.close()
+	self.assertEqual(blob.hexdigest(), md5)
+	self.assertEqual(blob.size, 12)
+
+    def test_missing_blob(self):
+	blob = BlobFile('git', '0' * 40)
+	self.assertEqual(blob.read(), '')
+	self.assertRaises(subprocess.CalledProcessError, blob.close)
+
+    def test_retry_sends_blob_again(self):
+	sha1, md5 = self.add_blob([os.urandom(1 << 20) for n in range(4)])
+	size = GitCatFile('git').info(sha1)[2]
+	self.server.drop_connections = True
+	transport = HTTPTransport(proxies={})
+	try:
+	    # The connection of this request is reused, and fails.
+	    transport.get(self.server.url('/source/p/k/f')).read()
+	    blob = BlobFile('git', sha1)
+	    transport.put(self.server.url('/source/p/k/f'), blob,
+			  {'Content-Length': str(size)}).read()
+	    blob.close()
+	finally:
+	    transport.close()
+	self.assertEqual(transport.pools.values()[0].opened, 2)
+	self.assertEqual(blob.hexdigest(), md5)
+	self.assertEqual(blob.size, size)
+	self.assertEqual(self.server.requests[-1]['md5'], md5)
+
+    def test_upload_memory(self):
+	sha1, md5 = self.add_blob([os.urandom(1 << 20)
+				   for n in range(BLOB_SIZE >> 20)])
+	env = dict(os.environ)
+	env['PYTHONPATH'] = os.path.dirname(os.path.dirname(
+	    os.path.abspath(__file__)))
+	proc = subprocess.Popen([sys.executable, '-c', UPLOAD,
+				 self.server.url('/source/p/k/f'), sha1,
+				 str(BLOB_SIZE)], stdout=PIPE, env=env)
+	output = proc.communicate()[0]
+	self.assertEqual(proc.returncode, 0)
+	uploaded_md5, growth = output.split()
+	self.assertEqual(uploaded_md5, md5)
+	self.assertEqual(self.server.requests[-1]['md5'], md5)
+	# The blob is streamed: memory use does not grow with its size.
+	self.assertTrue(int(growth) < (BLOB_SIZE >> 10) / 8,
+			'peak RSS grew by %s KiB' % growth)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+#!/usr/bin/python
+
+"""Tests for planning and fetching packages against a fake build service
+
+  Copyright (C) 2009  Andreas Gruenbacher <agruen@suse.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this library; if not, write to the Free Software Foundation,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import os
+import imp
+import hashlib
+import time
+import threading
+import unittest
+import shutil
+import subprocess
+import tempfile
+from StringIO import StringIO
+from bsgit.bscache import BuildServiceCache
+from bsgit.fastimport import GitFastImport
+from bsgit.transport import HTTPTransport
+from fakeserver import FakeServer
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+try:
+    bsgit = imp.load_source('bsgit_script', os.path.join(TOP, 'bsgit.py'))
+except ImportError:
+    # bsgit.py needs osc.
+    bsgit = None
+
+#-----------------------------------------------------------------------
+
+PKG1 = '%032x' % 1
+PKG2 = '%032x' % 2
+LNK1 = '%032x' % 3
+EXPANDED = '%032x' % 4
+
+def revisionlist(*revisions):
+    return '<revisionlist>' + ''.join(
+	['<revision rev="%s"><srcmd5>%s</srcmd5><time>%s</time>'
+	 '<user>alice</user><comment>rev %s</comment></revision>' %
+	 (rev, srcmd5, time, rev) for rev, srcmd5, time in revisions]) + \
+	'</revisionlist>'
+
+def directory(srcmd5, linkinfo=''):
+    return '<directory name="x" rev="1" srcmd5="%s">%s' \
+	   '<entry name="f" md5="%s"/></directory>' % \
+	   (srcmd5, linkinfo, '%032x' % 5)
+
+@unittest.skipIf(bsgit == None, 'osc is not installed')
+class FetchTestCase(unittest.TestCase):
+    """Run bsgit.py against a fake build service, in a new repository."""
+    def setUp(self):
+	self.old_cwd = os.getcwd()
+	self.repo = tempfile.mkdtemp()
+	os.chdir(self.repo)
+	subprocess.check_call(['git', 'init', '-q'])
+	self.server = FakeServer()
+	self.apiurl = self.server.url()
+	bsgit.transport = HTTPTransport(proxies={})
+	bsgit.bscache = BuildServiceCache('bscache.db', 'git')
+	bsgit.importer = GitFastImport('git')
+	bsgit.get_package_status.status = {}
+	bsgit.get_revision.history = {}
+	bsgit.check_link_uptodate.cached = {}
+	self.old_stderr = bsgit.stderr
+	bsgit.stderr = StringIO()
+
+    def tearDown(self):
+	bsgit.stderr = self.old_stderr
+	bsgit.importer.close()
+	bsgit.transport.close()
+	bsgit.bscache.close()
+	self.server.stop()
+	os.chdir(self.old_cwd)
+	shutil.rmtree(self.repo)
+
+    def route(self, path, query, body):
+	url = bsgit.osc.core.makeurl(self.apiurl, ['source'] + path, query)
+	self.server.routes[url[len(self.apiurl):]] = (200, {}, body)
+
+class PlanTest(FetchTestCase):
+    def setUp(self):
+	FetchTestCase.setUp(self)
+
+	# b/lnk links to a/pkg without a baserev; its link target has to
+	# be guessed from the revision times.
+	linkinfo = '<linkinfo project="a" package="pkg" srcmd5="%s"/>' % PKG2
+	self.route(['a', 'pkg', '_history'], None,
+		   revisionlist(('1', PKG1, 1200000000),
+				('2', PKG2, 1200000200)))
+	self.route(['a', 'pkg'], {'rev': '1'}, directory(PKG1))
+	self.route(['a', 'pkg'], {'rev': '2'}, directory(PKG2))
+	self.route(['a', 'pkg'], {'rev': 'latest', 'expand': '1'},
+		   directory(PKG2))
+	self.route(['b', 'lnk', '_history'], None,
+		   revisionlist(('1', LNK1, 1200000100)))
+	self.route(['b', 'lnk'], {'rev': '1'}, directory(LNK1, linkinfo))
+	self.route(['b', 'lnk'], {'rev': '1', 'linkrev': PKG1, 'expand': '1'},
+		   directory(EXPANDED))
+	self.route(['b', 'lnk'], {'rev': 'latest', 'expand': '1'},
+		   directory(EXPANDED, linkinfo))
+
+    def test_guess_reported_after_planning(self):
+	plan = bsgit.plan_fetch([(self.apiurl, 'b', 'lnk')])
+	self.assertTrue((self.apiurl, 'b', 'lnk', LNK1) in plan['nodes'])
+	self.assertTrue((self.apiurl, 'a', 'pkg', PKG1) in plan['nodes'])
+	self.assertEqual(bsgit.stderr.getvalue(), '')
+
+	status = bsgit.get_base_status(self.apiurl, 'b', 'lnk', '1')
+	self.assertEqual(status['srcmd5'], EXPANDED)
+	self.assertTrue('link target guessed as pkg(%s)' % PKG1 in
+			bsgit.stderr.getvalue())
+
+class PrefetchTest(FetchTestCase):
+    def test_wait_for_prefetched_file(self):
+	# fetch_files() must use a file which is still being prefetched
+	# rather than download it again.
+	contents = 'contents of f\n'
+	md5 = hashlib.md5(contents).hexdigest()
+	self.route(['p', 'k', 'f'], {'rev': PKG1}, contents)
+	bsgit.fetch_files.prefetching.add(md5)
+	def prefetch():
+	    time.sleep(0.2)
+	    download = bsgit.download_file(self.apiurl, 'p', 'k', PKG1, 'f',
+					   md5)
+	    with bsgit.fetch_files.lock:
+		bsgit.fetch_files.prefetched[md5] = download
+		bsgit.fetch_files.prefetching.discard(md5)
+		bsgit.fetch_files.prefetched_one.notify_all()
+	thread = threading.Thread(target=prefetch)
+	thread.start()
+	files = [{'name': 'f', 'md5': md5}]
+	bsgit.fetch_files(self.apiurl, 'p', 'k', PKG1, files)
+	thread.join()
+	self.assertEqual(len(self.server.requests), 1)
+	self.assertEqual(bsgit.bscache['blob ' + md5], files[0]['sha1'])
+	self.assertEqual(bsgit.fetch_files.prefetched, {})
+
+if __name__ == '__main__':
+    unittest.main()
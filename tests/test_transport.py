@@ -0,0 +1,198 @@
+#!/usr/bin/python
+
+"""Tests for bsgit.transport against a fake build service
+
+  Copyright (C) 2009  Andreas Gruenbacher <agruen@suse.de>
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or (at
+  your option) any later version.
+
+  This program is distributed in the hope that it will be useful, but
+  WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+  General Public License for more details.
+
+  You should have received a copy of the GNU General Public License
+  along with this library; if not, write to the Free Software Foundation,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import unittest
+import hashlib
+import base64
+from StringIO import StringIO
+from urllib2 import HTTPError
+from bsgit.transport import HTTPTransport, RecordingFile
+from bsgit.workers import run_parallel
+from fakeserver import FakeServer
+
+#-----------------------------------------------------------------------
+
+class SeekableBody:
+    """A request body which counts how often it was sent from the start."""
+    def __init__(self, data):
+	self.file = StringIO(data)
+	self.starts = 1
+
+    def read(self, size=-1):
+	return self.file.read(size)
+
+    def seek(self, offset):
+	self.file.seek(offset)
+	self.starts += 1
+
+class TransportTest(unittest.TestCase):
+    def setUp(self):
+	self.server = FakeServer()
+	self.server.routes['/source/p/k'] = (200, {}, '<directory/>')
+	self.transport = HTTPTransport(4, proxies={})
+
+    def tearDown(self):
+	self.transport.close()
+	self.server.stop()
+
+    def test_keep_alive(self):
+	for n in range(20):
+	    self.assertEqual(
+		self.transport.get(self.server.url('/source/p/k')).read(),
+		'<directory/>')
+	self.assertEqual(len(self.server.requests), 20)
+	connections = set([request['connection']
+			   for request in self.server.requests])
+	self.assertEqual(len(connections), 1)
+	self.assertTrue(self.transport.summary().startswith('1 connections'))
+
+    def test_parallel_requests(self):
+	url = self.server.url('/source/p/k')
+	results = run_parallel(lambda n: self.transport.get(url).read(),
+			       range(40), 8)
+	self.assertEqual(results, ['<directory/>'] * 40)
+	# No more connections than allowed per server.
+	connections = set([request['connection']
+			   for request in self.server.requests])
+	self.assertTrue(len(connections) <= 4)
+
+    def test_partial_read_does_not_reuse(self):
+	self.server.routes['/big'] = (200, {}, 'x' * 100000)
+	response = self.transport.get(self.server.url('/big'))
+	response.read(10)
+	response.close()
+	self.assertEqual(
+	    self.transport.get(self.server.url('/source/p/k')).read(),
+	    '<directory/>')
+
+    def test_http_error(self):
+	try:
+	    self.transport.get(self.server.url('/source/p/missing'))
+	    self.fail('no HTTPError raised')
+	except HTTPError, error:
+	    self.assertEqual(error.code, 404)
+	    self.assertEqual(error.read(), 'Not found')
+	# The connection remains usable.
+	self.assertEqual(
+	    self.transport.get(self.server.url('/source/p/k')).read(),
+	    '<directory/>')
+
+    def test_redirect(self):
+	self.server.routes['/old'] = (302, {'Location': '/source/p/k'}, '')
+	self.assertEqual(self.transport.get(self.server.url('/old')).read(),
+			 '<directory/>')
+	self.assertEqual([request['path'] for request in self.server.requests],
+			 ['/old', '/source/p/k'])
+
+    def test_basic_auth(self):
+	transport = HTTPTransport(credentials=lambda url: ('user', 'secret'),
+				  proxies={})
+	try:
+	    transport.get(self.server.url('/source/p/k')).read()
+	finally:
+	    transport.close()
+	self.assertEqual(self.server.requests[0]['headers']['authorization'],
+			 'Basic ' + base64.b64encode('user:secret'))
+
+    def test_conditional_get(self):
+	self.server.routes['/source/p/k/_history'] = \
+	    (304, {'ETag': '"1"'}, '')
+	response = self.transport.get(self.server.url('/source/p/k/_history'),
+				      {'If-None-Match': '"1"'})
+	self.assertEqual(response.status, 304)
+	self.assertEqual(response.read(), '')
+	self.assertEqual(
+	    self.server.requests[0]['headers']['if-none-match'], '"1"')
+
+    def test_put_file(self):
+	data = ''.join([chr(n % 256) for n in range(300000)])
+	self.server.routes['/source/p/k/f?rev=repository'] = (200, {}, '')
+	self.transport.put(self.server.url('/source/p/k/f?rev=repository'),
+			   StringIO(data),
+			   {'Content-Length': str(len(data))}).read()
+	request = self.server.requests[0]
+	self.assertEqual(request['method'], 'PUT')
+	self.assertEqual(request['md5'], hashlib.md5(data).hexdigest())
+
+    def test_retry_on_dropped_connection(self):
+	# The server closes each connection after a response, so the next
+	# request on the kept-alive connection fails and must be retried
+	# with the body sent again from the start.
+	self.server.drop_connections = True
+	self.server.routes['/source/p/k/f'] = (200, {}, '')
+	self.transport.get(self.server.url('/source/p/k')).read()
+	body = SeekableBody('contents of f')
+	self.transport.put(self.server.url('/source/p/k/f'), body,
+			   {'Content-Length': '13'}).read()
+	self.assertEqual(body.starts, 2)
+	self.assertEqual(self.server.requests[-1]['body'], 'contents of f')
+	self.assertEqual(self.transport.pools.values()[0].opened, 2)
+
+    def test_post_on_new_connection(self):
+	# A POST is never sent on a kept-alive connection: if that failed,
+	# the POST could not safely be sent again.
+	self.server.routes['/source/p/k?cmd=commit'] = (200, {}, '<status/>')
+	self.transport.get(self.server.url('/source/p/k')).read()
+	self.assertEqual(self.transport.post(
+	    self.server.url('/source/p/k?cmd=commit'), '<directory/>').read(),
+	    '<status/>')
+	get, post = self.server.requests
+	self.assertEqual(post['method'], 'POST')
+	self.assertNotEqual(post['connection'], get['connection'])
+	self.assertEqual(self.transport.pools.values()[0].opened, 2)
+
+    def test_recording_file(self):
+	response = self.transport.get(self.server.url('/source/p/k'))
+	recording = RecordingFile(response)
+	self.assertEqual(recording.read(), '<directory/>')
+	self.assertEqual(recording.getvalue(), '<directory/>')
+
+class ProxyTest(unittest.TestCase):
+    def setUp(self):
+	self.proxy = FakeServer()
+	self.proxy.routes['http://obs.example/source/p/k'] = \
+	    (200, {}, '<directory/>')
+
+    def tearDown(self):
+	self.proxy.stop()
+
+    def test_http_proxy(self):
+	proxy = 'http://joe:pw@127.0.0.1:%d' % self.proxy.server_port
+	transport = HTTPTransport(proxies={'http': proxy})
+	try:
+	    self.assertEqual(
+		transport.get('http://obs.example/source/p/k').read(),
+		'<directory/>')
+	finally:
+	    transport.close()
+	request = self.proxy.requests[0]
+	self.assertEqual(request['path'], 'http://obs.example/source/p/k')
+	self.assertEqual(request['headers']['proxy-authorization'],
+			 'Basic ' + base64.b64encode('joe:pw'))
+
+    def test_no_proxy(self):
+	transport = HTTPTransport(proxies={'http': self.proxy.url(),
+					   'no': 'obs.example'})
+	pool, auth = transport.pool('http', 'obs.example')
+	self.assertEqual(pool.proxy, None)
+
+if __name__ == '__main__':
+    unittest.main()